@@ -0,0 +1,57 @@
+"""
+Measures the cost of building a post body for batches of 1, 100 and 10,000
+entries: the StringIO/isoformat encoding Client._post used to redo on every
+attempt, the first encoding of a Payload, and a retry of the same Payload.
+
+Run from the repository root:
+
+    python benchmarks/encode.py
+"""
+import datetime
+import io
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from captions import Payload, TextEntry, wallclock
+
+SIZES = [1, 100, 10000]
+
+def old_encode(items, shift):
+    buf = io.StringIO(newline="\n")
+    for item in items:
+        print((wallclock(item.time) + shift).isoformat()[:-3], item.text.replace("\n", "<br>"), sep="\n", end="\n", file=buf, flush=True)
+    return buf.getvalue().encode('UTF-8')
+
+def new_encode(items, shift):
+    payload = Payload()
+    for item in items:
+        payload.add(item.time, Payload.encode(item.text))
+    return payload.body(shift)
+
+def best(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+def main():
+    shift = datetime.timedelta(milliseconds=12)
+    print("{:>7} {:>12} {:>12} {:>12}".format("entries", "old", "first", "retry"))
+    for size in SIZES:
+        items = []
+        for n in range(size):
+            item = TextEntry("word{n} ".format(n=n))
+            item.time += n * 37000001
+            items.append(item)
+        number = max(1, 10000 // size)
+        payload = Payload()
+        for item in items:
+            payload.add(item.time, Payload.encode(item.text))
+        payload.body(shift)
+        old = best(lambda: old_encode(items, shift), number)
+        first = best(lambda: new_encode(items, shift), number)
+        retry = best(lambda: payload.body(shift), number * 100)
+        print("{:>7} {:>9.1f} us {:>9.1f} us {:>9.2f} us".format(size, old * 1e6, first * 1e6, retry * 1e6))
+
+if __name__ == "__main__":
+    main()
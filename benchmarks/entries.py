@@ -0,0 +1,90 @@
+"""
+Measures the memory held by a 4-hour captioning session's entries and the
+time spent on the per-tick work that reads entry times, for TextEntry and
+for the dict-backed, datetime-stamped entry it replaced.
+
+Run from the repository root:
+
+    python benchmarks/entries.py
+"""
+import datetime
+import os.path
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from captions import Client, ReleasePolicy, TextEntry
+
+HOURS = 4
+RATE = 10 # entries per second, one per keystroke burst
+TICKS = 1000
+
+class OldEntry:
+    def __init__(self, text=''):
+        self.time = datetime.datetime.utcnow()
+        self.text = text
+        self.status = TextEntry.PENDING
+
+def session(cls, start, step):
+    """Returns the entries of a session, stamped step apart from start."""
+    words = ["word{n} ".format(n=n % 5000) for n in range(5000)]
+    entries = []
+    for n in range(HOURS * 3600 * RATE):
+        item = cls(words[n % len(words)])
+        item.time = start + n * step
+        item.status = TextEntry.SUCCESS
+        entries.append(item)
+    return entries
+
+def measure(cls, start, step):
+    tracemalloc.start()
+    entries = session(cls, start, step)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return entries, size
+
+def old_tick(entries, now, policy_delay, history_age):
+    # What Client._confirm and the release policy did with datetimes.
+    cutoff = datetime.datetime.utcnow() - history_age
+    entries[0].time < cutoff - history_age / 10
+    count = 0
+    for item in entries[-50:]:
+        if now - item.time < policy_delay:
+            break
+        count += 1
+    return count
+
+def main():
+    count = HOURS * 3600 * RATE
+    old, old_size = measure(OldEntry, datetime.datetime.utcnow(), datetime.timedelta(seconds=1 / RATE))
+    new, new_size = measure(TextEntry, time.monotonic_ns(), 10 ** 9 // RATE)
+    print("{count} entries".format(count=count))
+    print("{:>10} {:>12} {:>14}".format("", "MB", "bytes/entry"))
+    print("{:>10} {:>12.1f} {:>14.0f}".format("old", old_size / 1e6, old_size / count))
+    print("{:>10} {:>12.1f} {:>14.0f}".format("new", new_size / 1e6, new_size / count))
+
+    now = old[-1].time
+    delay = datetime.timedelta(seconds=5)
+    age = datetime.timedelta(minutes=30)
+    start = time.perf_counter()
+    for _ in range(TICKS):
+        old_tick(old, now, delay, age)
+    old_tick_time = (time.perf_counter() - start) / TICKS
+
+    client = Client()
+    client.history_size = count
+    client._confirmed.extend(new)
+    policy = ReleasePolicy(min_interval=0) # every call does the full check
+    pending = new[-50:]
+    now = new[-1].time
+    start = time.perf_counter()
+    for _ in range(TICKS):
+        client._confirm([], TextEntry.SUCCESS)
+        policy.release(pending, now, 0)
+    new_tick_time = (time.perf_counter() - start) / TICKS
+    print("tick: old {old:.1f} us, new {new:.1f} us".format(old=old_tick_time * 1e6, new=new_tick_time * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Measures the GUI's per-tick hot paths against transcripts from 1k to 1M
+characters:
+
+    display    MyFrame._display after a tick of new and settled entries
+    bulk_ack   MyFrame._display after half the transcript is acknowledged at once
+    layout     wrapping the text of that tick on the layout thread
+    best_size  ColoredStaticText.DoGetBestSize after a tick of new text
+    paint      ColoredStaticText.OnPaint of the visible part of the pane
+    wrap       ColoredStaticText.Wrap to a new width, as on a resize, until
+               the new layout is shown
+    on_text    MyFrame.OnText for a word typed or a character deleted
+
+Results can be saved as a JSON baseline, and a later run compared against
+it; any path more than --threshold slower than the baseline is reported
+and the exit status is 1. Run from the repository root. Without a display
+it starts itself under xvfb-run:
+
+    python benchmarks/gui.py --save baseline.json
+    python benchmarks/gui.py --compare baseline.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+WORDS = """Lorem ipsum dolor sit amet, cum fastidii perfecto legendos et, eu vocent
+efficiantur est, in reque appareat lucilius quo. Cu nibh illum pri. Id vim vero
+consequat consetetur. Quod suscipit intellegam nam ex, mel modo mazim animal ex.""".split()
+SIZES = [1000, 10000, 100000, 1000000]
+TICK_WORDS = 6 # about one second of fast writing
+SIZE = (800, 600)
+
+def words(rng):
+    while True:
+        yield rng.choice(WORDS) + ("\n" if rng.random() < 0.01 else " ")
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+def add(frame, items, status):
+    """Adds items to the frame's client with status, as if they had been sent."""
+    client = frame.client
+    with client.lock:
+        start = client.spans.end
+        for item in items:
+            item.status = status
+        client._confirmed.extend(items)
+        client.spans.append(sum(len(item.text) for item in items), status)
+        end = client.spans.end
+    frame._on_change([(start, end, status)])
+    return start, end
+
+def settle(frame, start, end, status):
+    """Sets the status of the client's text from start to end."""
+    with frame.client.lock:
+        frame.client.spans.set(start, end, status)
+    frame._on_change([(start, end, status)])
+
+def bench(size, ticks, rng):
+    """Returns the median seconds per call of each path for a transcript of size characters."""
+    import wx
+    from captions import Histogram, TextEntry
+    from client import MyFrame
+
+    frame = MyFrame()
+    frame.SetSize(SIZE)
+    client = frame.client
+    client.history_size = 10 ** 9
+    client.history_age = None
+    frame._policy.delay = 10 ** 6 # nothing is released while typing
+    output = frame.output
+    source = words(rng)
+    items = []
+    length = 0
+    while length < size:
+        items.append(TextEntry(next(source)))
+        length += len(items[-1].text)
+    add(frame, items, TextEntry.SUCCESS)
+    frame._display()
+    output.FinishLayout()
+    output.paint_histogram = Histogram()
+    results = {name: [] for name in ('display', 'bulk_ack', 'layout', 'best_size', 'paint', 'wrap', 'on_text')}
+
+    sent = None
+    for i in range(ticks):
+        # A tick settles the entries of the last one and adds more.
+        if sent:
+            settle(frame, *sent, TextEntry.SUCCESS)
+        sent = add(frame, [TextEntry(next(source)) for _ in range(TICK_WORDS)], TextEntry.SENT)
+        results['display'].append(timed(frame._display))
+        output.FinishLayout()
+        results['layout'].append(output._shown.seconds)
+
+        results['best_size'].append(timed(output.DoGetBestSize))
+
+        paints = output.paint_histogram.count, output.paint_histogram.sum
+        output.Refresh()
+        output.Update()
+        if output.paint_histogram.count > paints[0]:
+            results['paint'].append((output.paint_histogram.sum - paints[1]) / (output.paint_histogram.count - paints[0]))
+
+        width = frame.scroll.GetSize().width
+        results['wrap'].append(timed(lambda: (output.Wrap(width - 20), output.FinishLayout())))
+        output.Wrap(width)
+        output.FinishLayout()
+
+        half = (client.spans.start + client.spans.end) // 2
+        settle(frame, half, client.spans.end, TextEntry.SENT)
+        frame._display()
+        settle(frame, half, client.spans.end, TextEntry.SUCCESS)
+        results['bulk_ack'].append(timed(frame._display))
+
+    # OnText is timed on its own, with the input holding the transcript.
+    text = output._text
+    frame.input.Unbind(wx.EVT_TEXT)
+    frame.input.ChangeValue(text)
+    frame._pending.sync(text, time.monotonic_ns(), frame._policy)
+    for i in range(ticks):
+        frame.input.SetInsertionPointEnd()
+        frame._selection = frame.input.GetSelection()
+        if i % 2:
+            end = frame.input.GetLastPosition()
+            frame.input.Remove(end - 1, end)
+        else:
+            frame.input.WriteText(next(source))
+        results['on_text'].append(timed(frame.OnText, None))
+
+    frame.Close(force=True)
+    return {name: statistics.median(times) if times else None for name, times in results.items()}
+
+def compare(results, baseline, threshold):
+    """Prints each result against the baseline and returns the names of regressions."""
+    regressions = []
+    print("{:>10} {:>10} {:>12} {:>12} {:>8}".format("path", "chars", "ms", "baseline", "change"))
+    for name, sizes in results.items():
+        for size, value in sizes.items():
+            old = baseline.get(name, {}).get(size)
+            change = ''
+            if value is not None and old:
+                ratio = value / old - 1
+                change = '{:+.0%}'.format(ratio)
+                if ratio > threshold:
+                    change += ' !'
+                    regressions.append('{name}/{size}'.format(name=name, size=size))
+            print("{:>10} {:>10} {:>12} {:>12} {:>8}".format(name, size, ms(value), ms(old), change))
+    return regressions
+
+def ms(value):
+    return '-' if value is None else '{:.3f}'.format(value * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the GUI's per-tick hot paths.")
+    parser.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=SIZES, help="transcript lengths in characters, separated by commas")
+    parser.add_argument('--ticks', type=int, default=20, help="calls to time for each path and size")
+    parser.add_argument('--save', metavar='PATH', help="write the results to PATH as a JSON baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare the results with the baseline in PATH")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown, as a fraction, reported as a regression")
+    args = parser.parse_args()
+
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+        xvfb = shutil.which('xvfb-run')
+        if not xvfb:
+            sys.exit("no display, and xvfb-run isn't installed")
+        sys.exit(subprocess.call([xvfb, '-a', '-s', '-screen 0 1280x1024x24', sys.executable] + sys.argv))
+
+    import wx
+    # A home of its own keeps the benchmark's journal apart from the app's.
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='captions-bench-')
+    app = wx.App(False)
+    rng = random.Random(0)
+    results = {}
+    for size in args.sizes:
+        for name, value in bench(size, args.ticks, rng).items():
+            results.setdefault(name, {})[str(size)] = value
+    shutil.rmtree(os.environ['HOME'], ignore_errors=True)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'wx': wx.version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=1)
+    if regressions:
+        print("slower than the baseline by more than {:.0%}: {}".format(args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
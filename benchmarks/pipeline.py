@@ -0,0 +1,64 @@
+"""
+Measures caption throughput and worst-case lag through Client for several
+sending window sizes while server.py fails a fraction of the posts.
+
+Start the server with the failure rate to test, then run from the
+repository root:
+
+    python server.py --fail-rate 0.3 --latency 0.15 > /dev/null &
+    python benchmarks/pipeline.py [url]
+
+Each window size sends to a stream of its own, named by adding a run
+parameter to the URL, so no run inherits the server's sequence state
+from another.
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from captions import Client, TextEntry
+
+WINDOWS = [1, 2, 4, 8]
+ENTRIES = 200
+RATE = 20 # entries per second
+
+def run(url, window):
+    client = Client()
+    client.url = url
+    client.window = window
+    client.start()
+    sent = {}
+    done = {}
+    start = time.monotonic()
+    next_send = start
+    while len(done) < ENTRIES:
+        now = time.monotonic()
+        if len(sent) < ENTRIES and now >= next_send:
+            item = TextEntry("word{n} ".format(n=len(sent)))
+            sent[item] = now
+            client.send([item])
+            next_send += 1 / RATE
+        with client.lock:
+            for item in sent:
+                if item not in done and item.status in (TextEntry.SUCCESS, TextEntry.FAILED):
+                    done[item] = now
+        time.sleep(0.005)
+    client.stop()
+    elapsed = max(done.values()) - start
+    lags = [done[item] - sent[item] for item in sent]
+    failed = sum(1 for item in sent if item.status == TextEntry.FAILED)
+    return ENTRIES / elapsed, max(lags), sum(lags) / len(lags), failed
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:8080/?bench'
+    stamp = int(time.time())
+    print("{:>6} {:>12} {:>10} {:>10} {:>7}".format("window", "entries/s", "max lag", "mean lag", "failed"))
+    for window in WINDOWS:
+        stream = "{url}&run={stamp}-{window}".format(url=url, stamp=stamp, window=window)
+        throughput, worst, mean, failed = run(stream, window)
+        print("{:>6} {:>12.1f} {:>8.2f} s {:>8.2f} s {:>7}".format(window, throughput, worst, mean, failed))
+
+if __name__ == "__main__":
+    main()
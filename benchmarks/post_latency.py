@@ -0,0 +1,59 @@
+"""
+Measures per-post latency against the local server.py stand-in, opening a
+new connection for every post (as requests.post did) and reusing the
+Client's keep-alive Transport.
+
+Start the server first, then run from the repository root:
+
+    python server.py &
+    python benchmarks/post_latency.py [url]
+"""
+import http.client
+import os.path
+import statistics
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from captions import Transport, TransportError
+
+POSTS = 200
+TIMEOUT = 5
+HEADERS = {'content-type': 'text/plain'}
+BODY = b"2015-07-24T12:00:00.000\nLorem ipsum dolor sit amet\n"
+
+def fresh_post(url, body, headers, timeout):
+    parts = urllib.parse.urlsplit(url)
+    cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = cls(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.request('POST', parts.path + '?' + parts.query, body, headers)
+        conn.getresponse().read()
+    finally:
+        conn.close()
+
+def measure(post, url):
+    times = []
+    for seq in range(POSTS):
+        start = time.perf_counter()
+        try:
+            post(url + "&seq={seq}".format(seq=seq), BODY, HEADERS, TIMEOUT)
+        except TransportError:
+            pass # server.py fails some posts on purpose
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.mean(times), times[len(times) // 2], times[int(len(times) * 0.99)]
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:8080/?bench'
+    transport = Transport()
+    transport.warm(url)
+    print("{:>12} {:>10} {:>10} {:>10}".format("", "mean", "p50", "p99"))
+    for name, post in [("new conn", fresh_post), ("keep-alive", transport.post)]:
+        mean, p50, p99 = measure(post, url)
+        print("{:>12} {:>7.3f} ms {:>7.3f} ms {:>7.3f} ms".format(name, mean * 1000, p50 * 1000, p99 * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Runs many Clients at once against the simulator and reports throughput,
+acknowledgement latency and what the server saw.
+
+Start the simulator with the conditions to test, then run from the
+repository root:
+
+    python server.py --fail-rate 0.05 --latency 0.05 --latency-dist exponential &
+    python benchmarks/scale.py [clients] [url]
+"""
+import json
+import os.path
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from captions import Client, Scheduler, TextEntry
+
+ENTRIES = 50 # per client
+RATE = 5 # entries per second per client
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    url = sys.argv[2] if len(sys.argv) > 2 else 'http://localhost:8080/'
+    scheduler = Scheduler.shared()
+    clients = []
+    for n in range(count):
+        client = Client(scheduler)
+        client.url = url + "?client={n}".format(n=n)
+        client.window = 2
+        client.start()
+        clients.append(client)
+    sent = []
+    start = time.monotonic()
+    for i in range(ENTRIES):
+        for n, client in enumerate(clients):
+            item = TextEntry("client{n} word{i} ".format(n=n, i=i))
+            sent.append(item)
+            client.send([item])
+        time.sleep(max(start + (i + 1) / RATE - time.monotonic(), 0))
+    while any(item.status in (TextEntry.PENDING, TextEntry.SENT) for item in sent):
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+    for client in clients:
+        client.stop()
+
+    failed = sum(1 for item in sent if item.status == TextEntry.FAILED)
+    ack = {}
+    for client in clients:
+        for name, value in client.metrics.snapshot().items():
+            if name == 'caption_ack_seconds' and value['count']:
+                ack.setdefault('p50', []).append(value['p50'])
+                ack.setdefault('p99', []).append(value['p99'])
+    print("{clients} clients, {entries} entries in {elapsed:.1f} s, {rate:.0f} entries/s, {failed} failed".format(
+        clients=count, entries=len(sent), elapsed=elapsed, rate=len(sent) / elapsed, failed=failed))
+    if ack:
+        print("ack latency: median client p50 {p50:.0f} ms, worst client p99 {p99:.0f} ms".format(
+            p50=sorted(ack['p50'])[len(ack['p50']) // 2] * 1000, p99=max(ack['p99']) * 1000))
+    try:
+        with urllib.request.urlopen(url.rstrip('/') + '/stats') as response:
+            print("server:", json.load(response))
+    except OSError:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Measures how long a fresh interpreter takes to import the headless core
+(captions) and the GUI (client, which loads wx).
+
+Run from the repository root:
+
+    python benchmarks/startup.py
+"""
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+RUNS = 10
+
+def measure(module):
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + module], cwd=ROOT, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    baseline = measure('sys')
+    print("{:>10} {:>10}".format("", "ms"))
+    print("{:>10} {:>10.0f}".format("python", baseline * 1000))
+    for module in ('captions', 'client'):
+        try:
+            print("{:>10} {:>10.0f}".format(module, measure(module) * 1000))
+        except subprocess.CalledProcessError:
+            print("{:>10} {:>10}".format(module, "failed"))
+
+if __name__ == "__main__":
+    main()
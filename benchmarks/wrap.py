@@ -0,0 +1,95 @@
+"""
+Measures the cost of wrapping the caption pane once per tick for large
+transcripts, comparing ColoredStaticText's incremental wrapper against the
+old approach of running wx.lib.wordwrap over the whole label and walking
+the result to put the newlines back into the runs.
+
+Run from the repository root with a display (or under xvfb-run):
+
+    python benchmarks/wrap.py
+"""
+import os.path
+import random
+import sys
+import time
+import wx
+import wx.lib.wordwrap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from client import ColoredStaticText, ColoredText
+
+WORDS = """Lorem ipsum dolor sit amet, cum fastidii perfecto legendos et, eu vocent
+efficiantur est, in reque appareat lucilius quo. Cu nibh illum pri. Id vim vero
+consequat consetetur. Quod suscipit intellegam nam ex, mel modo mazim animal ex.""".split()
+SIZES = [10000, 100000, 1000000]
+WIDTH = 600
+TICK_CHARS = 40
+
+def transcript(size, rng):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS) + ("\n" if rng.random() < 0.01 else " ")
+        words.append(word)
+        length += len(word)
+    return ''.join(words)
+
+def label(text, sent):
+    return [ColoredText(text[:sent], "black", "green"), ColoredText(text[sent:], "black", "light gray")]
+
+def old_wrap(runs, width, dc):
+    text = ''.join(item.text for item in runs)
+    newlabel = wx.lib.wordwrap.wordwrap(text, width, dc)
+    if text != newlabel:
+        currindex = 0
+        offset = 0
+        for c in newlabel:
+            if currindex >= len(runs):
+                break
+            curr = runs[currindex]
+            if c != curr.text[offset]:
+                curr.text = curr.text[:offset] + c + curr.text[offset:]
+            offset += 1
+            if offset >= len(curr.text):
+                currindex += 1
+                offset = 0
+    return runs
+
+def bench(ctrl, size, ticks, rng):
+    text = transcript(size, rng)
+    extra = transcript(ticks * TICK_CHARS, rng)
+    ctrl.Wrap(WIDTH, label(text, len(text)))
+    ctrl.FinishLayout()
+    dc = wx.ClientDC(ctrl)
+    dc.SetFont(ctrl.GetFont())
+
+    new = 0
+    old = 0
+    for i in range(ticks):
+        sent = len(text)
+        text += extra[i * TICK_CHARS:(i + 1) * TICK_CHARS]
+        start = time.perf_counter()
+        ctrl.Wrap(WIDTH, label(text, sent))
+        ctrl.FinishLayout()
+        new += time.perf_counter() - start
+        if i < 3:
+            start = time.perf_counter()
+            old_wrap(label(text, sent), WIDTH, dc)
+            old += time.perf_counter() - start
+    return new / ticks, old / min(ticks, 3)
+
+def main():
+    app = wx.App(False)
+    frame = wx.Frame(None, size=(WIDTH, 400))
+    rng = random.Random(0)
+    print("{:>10} {:>14} {:>14}".format("chars", "incremental", "wordwrap"))
+    for size in SIZES:
+        ctrl = ColoredStaticText(frame)
+        new, old = bench(ctrl, size, 20, rng)
+        print("{:>10} {:>11.3f} ms {:>11.3f} ms".format(size, new * 1000, old * 1000))
+        ctrl.Destroy()
+    frame.Destroy()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2504 @@
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import functools
+import heapq
+import http.client
+import http.server
+import io
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import traceback
+import urllib.parse
+
+# Entry times are time.monotonic_ns() values, so they can't jump when the
+# system clock is set. They are turned into wall-clock times only when
+# written out, relative to this pair of readings.
+_wallclock_base = datetime.datetime.utcnow()
+_monotonic_base = time.monotonic_ns()
+_monotonic_ns = time.monotonic_ns
+
+def wallclock(ns):
+    """Returns the UTC datetime of a time.monotonic_ns() value."""
+    return _wallclock_base + datetime.timedelta(microseconds=(ns - _monotonic_base) // 1000)
+
+def monotonic(dt):
+    """Returns the time.monotonic_ns() value of a UTC datetime."""
+    return _monotonic_base + (dt - _wallclock_base) // datetime.timedelta(microseconds=1) * 1000
+
+class TextEntry:
+    PENDING = 0
+    SENT = 1
+    SUCCESS = 2
+    FAILED = 3
+
+    # A long session holds hundreds of thousands of these.
+    __slots__ = ('time', 'text', 'status')
+    
+    def __init__(self, text='', time=None):
+        self.time = _monotonic_ns() if time is None else time
+        self.text = text
+        self.status = TextEntry.PENDING
+        
+    def __repr__(self):
+        return "TextEntry({time}, {text}, {status})".format(time=self.time,text=self.text,status=self.status)
+
+class StatusSpans:
+    """
+    The status of every character of the entries a Client holds, as runs of
+    one status. Positions count characters from the start of the session,
+    so they stay put when old text is dropped from the front, and changing
+    the status of a range costs a bisection and the runs it covers.
+    """
+    def __init__(self):
+        self.start = 0
+        self.end = 0
+        self._starts = []
+        self._statuses = []
+
+    def __iter__(self):
+        """Yields (start, end, status) for each run, oldest first."""
+        return zip(self._starts, self._starts[1:] + [self.end], self._statuses)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def append(self, length, status):
+        if not length:
+            return
+        if not self._statuses or self._statuses[-1] != status:
+            self._starts.append(self.end)
+            self._statuses.append(status)
+        self.end += length
+
+    def set(self, start, end, status):
+        """Sets the status of the characters from start to end."""
+        start = max(start, self.start)
+        end = min(end, self.end)
+        if start >= end:
+            return
+        first = self._split(start)
+        last = self._split(end) if end < self.end else len(self._starts)
+        self._starts[first:last] = [start]
+        self._statuses[first:last] = [status]
+        # Merge with runs of the same status on either side.
+        if first + 1 < len(self._starts) and self._statuses[first + 1] == status:
+            del self._starts[first + 1]
+            del self._statuses[first + 1]
+        if first > 0 and self._statuses[first - 1] == status:
+            del self._starts[first]
+            del self._statuses[first]
+
+    def drop(self, end):
+        """Forgets the characters before end."""
+        end = min(end, self.end)
+        if end <= self.start:
+            return
+        index = bisect.bisect_right(self._starts, end) - 1
+        del self._starts[:index]
+        del self._statuses[:index]
+        if end == self.end:
+            self._starts.clear()
+            self._statuses.clear()
+        else:
+            self._starts[0] = end
+        self.start = end
+
+    def _split(self, offset):
+        """Ensures a run starts at offset and returns its index."""
+        index = bisect.bisect_right(self._starts, offset) - 1
+        if self._starts[index] == offset:
+            return index
+        self._starts.insert(index + 1, offset)
+        self._statuses.insert(index + 1, self._statuses[index])
+        return index + 1
+
+class ReleasePolicy:
+    """
+    Decides when text typed into the input box is settled enough to send.
+    This base policy releases text once it is older than delay seconds.
+    Releases come at least min_interval seconds apart, and no faster than
+    posts complete, so text released together goes out in one post; text
+    can wait that much past delay. Times passed in and returned are
+    time.monotonic_ns() values.
+    """
+    def __init__(self, delay=5, min_interval=1):
+        self.delay = delay
+        self.min_interval = min_interval
+        self._last_release = None
+
+    def keystroke(self, now):
+        """Called whenever the input changes."""
+        pass
+
+    def corrected(self, item, now):
+        """Called when unreleased text in item is changed or deleted."""
+        pass
+
+    def release(self, pending, now, rtt):
+        """
+        Returns how many entries at the front of pending to send now. rtt is
+        the recent post round-trip time in seconds. Sending any of them
+        should be reported to released(), from which the next release is
+        spaced.
+        """
+        if self._waiting(now, rtt):
+            return 0
+        delay = int(self.delay * 1e9)
+        count = 0
+        for item in pending:
+            if now - item.time < delay:
+                break
+            count += 1
+        return count
+
+    def released(self, now):
+        """Called when entries release() allowed have been sent."""
+        self._last_release = now
+
+    def deadline(self, pending, now, rtt):
+        """
+        Returns the time at which release might next return more entries
+        without any further typing, or ``None`` if nothing is pending.
+        """
+        if not pending:
+            return None
+        return self._spaced(pending[0].time + int(self.delay * 1e9), rtt)
+
+    def _waiting(self, now, rtt):
+        """Returns whether it is too soon after the last release for another."""
+        return now < self._spaced(now, rtt)
+
+    def _spaced(self, deadline, rtt):
+        """Returns deadline, moved back to keep releases apart."""
+        if self._last_release is None:
+            return deadline
+        return max(deadline, self._last_release + int(max(self.min_interval, rtt) * 1e9))
+
+class AdaptivePolicy(ReleasePolicy):
+    """
+    Releases text that ends at a word boundary once it has been left alone
+    long enough that it is unlikely to be corrected. The hold time follows
+    the typing cadence and how old text usually is when it gets corrected,
+    between min_hold and delay. Text older than delay is always released.
+    """
+    _boundary = frozenset(' \t\n.,;:!?')
+
+    def __init__(self, delay=5, min_hold=0.5, min_interval=1):
+        super().__init__(delay, min_interval)
+        self.min_hold = min_hold
+        self._interval = None # moving average of seconds between keystrokes
+        self._last_key = None
+        self._corrections = collections.deque(maxlen=200) # ages, in seconds, of corrected text
+
+    def keystroke(self, now):
+        if self._last_key is not None:
+            interval = (now - self._last_key) / 1e9
+            if interval < self.delay:
+                self._interval = interval if self._interval is None else 0.9 * self._interval + 0.1 * interval
+        self._last_key = now
+
+    def corrected(self, item, now):
+        self._corrections.append((now - item.time) / 1e9)
+
+    def hold(self):
+        """Returns how long, in seconds, text is held before it may be released."""
+        hold = self.min_hold
+        if self._interval is not None:
+            hold = max(hold, 3 * self._interval)
+        if self._corrections:
+            ages = sorted(self._corrections)
+            hold = max(hold, ages[int(len(ages) * 0.95)])
+        return min(hold, self.delay)
+
+    def release(self, pending, now, rtt):
+        if self._waiting(now, rtt):
+            return 0
+        hold = self.hold()
+        delay = int(self.delay * 1e9)
+        hold = int(hold * 1e9)
+        forced = 0
+        stable = 0
+        previous = None
+        for count, item in enumerate(pending):
+            # With spaces before words the boundary is the start of the
+            # next entry, so an entry is only known to end a word once the
+            # next one starts.
+            if previous is not None and (previous.text[-1:] in self._boundary or item.text[:1] in self._boundary):
+                stable = count
+            age = now - item.time
+            if age >= delay:
+                forced = count + 1
+            if age < hold:
+                break
+            previous = item
+        else:
+            # Everything is old enough; the last word is done if it ends
+            # in a boundary or typing has paused. Without keystrokes there
+            # is no pause to see, as in deadline().
+            paused = self._last_key is not None and now - self._last_key >= 2 * hold
+            if previous is not None and (previous.text[-1:] in self._boundary or paused):
+                stable = len(pending)
+        return max(forced, stable)
+
+    def deadline(self, pending, now, rtt):
+        if not pending:
+            return None
+        hold = int(self.hold() * 1e9)
+        deadline = pending[0].time + int(self.delay * 1e9)
+        for item in pending:
+            if item.time + hold > now:
+                deadline = min(deadline, item.time + hold)
+                break
+        else:
+            if self._last_key is not None:
+                deadline = min(deadline, self._last_key + 2 * hold)
+        return self._spaced(deadline, rtt)
+
+class PendingText:
+    """
+    The unreleased text in the input box, as a sequence of entries. The end
+    offset of every entry is kept in a list, so the entries an edit touches
+    are found by bisection. Only the offsets after an edit need updating,
+    and edits almost always happen at the end. Released entries are
+    dropped from the front by moving a head index.
+    """
+    def __init__(self):
+        self._entries = []
+        self._ends = [] # offset just past each entry, counted from the first entry ever
+        self._head = 0 # index of the first unreleased entry
+        self._base = 0 # offset of the first unreleased character
+        self.newlines = 0
+
+    def __len__(self):
+        return len(self._entries) - self._head
+
+    def __iter__(self):
+        return itertools.islice(self._entries, self._head, None)
+
+    def __getitem__(self, index):
+        return self._entries[self._head + index if index >= 0 else index]
+
+    def length(self):
+        return self._ends[-1] - self._base if len(self) else 0
+
+    def text(self, start, end):
+        """Returns the pending text from offset start to end."""
+        start += self._base
+        end += self._base
+        pieces = []
+        i = bisect.bisect_right(self._ends, start, self._head)
+        while i < len(self._entries) and start < end:
+            item = self._entries[i]
+            itemstart = self._ends[i] - len(item.text)
+            pieces.append(item.text[start - itemstart:end - itemstart])
+            start = self._ends[i]
+            i += 1
+        return ''.join(pieces)
+
+    def edit(self, offset, removed, inserted, now, policy):
+        """
+        Replaces removed characters at offset with inserted. Entries that lose
+        text are split around the edit, keeping their times, and the inserted
+        text becomes a new entry.
+        """
+        a = self._base + offset
+        b = a + removed
+        i = bisect.bisect_right(self._ends, a, self._head)
+        if i == len(self._entries):
+            j = i
+        elif removed:
+            j = bisect.bisect_left(self._ends, b, i) + 1
+        else:
+            j = i if self._ends[i] - len(self._entries[i].text) == a else i + 1
+        pieces = []
+        if i < j:
+            first = self._entries[i]
+            firststart = self._ends[i] - len(first.text)
+            if firststart < a:
+                prefix = TextEntry(first.text[:a - firststart], first.time)
+                pieces.append(prefix)
+        if inserted:
+            pieces.append(TextEntry(inserted, now))
+        if i < j:
+            last = self._entries[j - 1]
+            if self._ends[j - 1] > b:
+                suffix = TextEntry(last.text[len(last.text) - (self._ends[j - 1] - b):], last.time)
+                pieces.append(suffix)
+            for item in self._entries[i:j]:
+                policy.corrected(item, now)
+                self.newlines -= item.text.count('\n')
+        ends = []
+        end = self._ends[i - 1] if i > self._head else self._base
+        for item in pieces:
+            end += len(item.text)
+            ends.append(end)
+            self.newlines += item.text.count('\n')
+        self._entries[i:j] = pieces
+        self._ends[i:j] = ends
+        delta = len(inserted) - removed
+        if delta:
+            for k in range(i + len(pieces), len(self._ends)):
+                self._ends[k] += delta
+
+    def sync(self, text, now, policy):
+        """Brings the entries up to date with text by comparing it with all of them."""
+        entries = []
+        for item in self:
+            piece = text[:len(item.text)]
+            text = text[len(item.text):]
+            if item.text == piece:
+                entries.append(item)
+            else:
+                policy.corrected(item, now)
+                common = os.path.commonprefix([item.text, piece])
+                if common:
+                    prefix = TextEntry()
+                    prefix.time = item.time
+                    prefix.text = common
+                    entries.append(prefix)
+                text = piece[len(common):] + text
+                if text:
+                    suffix = TextEntry(time=now)
+                    suffix.text = text
+                    entries.append(suffix)
+                    text = ''
+                break
+        if text:
+            entries.append(TextEntry(text, now))
+        self._entries = entries
+        self._ends = list(itertools.accumulate((len(item.text) for item in entries), initial=self._base))[1:]
+        self._head = 0
+        self.newlines = sum(item.text.count('\n') for item in entries)
+
+    def release(self, count):
+        """Removes the first count entries and returns them."""
+        items = self._entries[self._head:self._head + count]
+        if items:
+            self._head += len(items)
+            self._base = self._ends[self._head - 1]
+            self.newlines -= sum(item.text.count('\n') for item in items)
+            if self._head > 1024 and self._head * 2 > len(self._entries):
+                del self._entries[:self._head]
+                del self._ends[:self._head]
+                self._head = 0
+        return items
+
+class Archive:
+    """
+    Stores entries that have dropped out of the in-memory history in a file,
+    one JSON line per entry, in pages that can be read back individually.
+    """
+    def __init__(self, path=None, page_size=100):
+        self._file = open(path, 'w+b') if path else tempfile.TemporaryFile()
+        self._page_size = page_size
+        self._pages = [] # file offset of the first entry of each page
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def pages(self):
+        return len(self._pages)
+
+    def append(self, items):
+        f = self._file
+        f.seek(0, io.SEEK_END)
+        for item in items:
+            if self._count % self._page_size == 0:
+                self._pages.append(f.tell())
+            f.write(json.dumps([wallclock(item.time).strftime("%Y-%m-%dT%H:%M:%S.%f"), item.status, item.text]).encode('UTF-8') + b'\n')
+            self._count += 1
+        f.flush()
+
+    def page(self, index):
+        """Returns the entries on page index, oldest first."""
+        f = self._file
+        f.seek(self._pages[index])
+        items = []
+        for _ in range(min(self._page_size, self._count - index * self._page_size)):
+            time, status, text = json.loads(f.readline().decode('UTF-8'))
+            item = TextEntry(text)
+            item.time = monotonic(datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f"))
+            item.status = status
+            items.append(item)
+        return items
+
+    def close(self):
+        self._file.close()
+
+class JournalLocked(Exception):
+    """Raised when another process is already writing to a journal."""
+
+def _lock(path):
+    """Returns the file at path, opened and locked against other processes."""
+    f = open(path, 'a+b')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        raise JournalLocked(path)
+    return f
+
+class Journal:
+    """
+    Append-only record of the entries given to a Client and of their final
+    statuses, so a crash loses nothing. Each line is JSON: ``["e", time,
+    text]`` for an entry, with its UTC time, and ``["s", count, status]``
+    when the oldest count entries not yet settled get their final status.
+    Records are written and synced in groups on a thread of its own, so
+    adding them never waits for the disk.
+
+    One journal holds one session. Only one process may write to it, and
+    once everything in it is settled, closing it can retire it under a
+    dated name. Beside it, in path.start, is kept where replay() needs to
+    begin: at the oldest of the last history entries or the first
+    unsettled one, whichever comes first, so a long session is not read
+    from the top after a crash.
+    """
+    def __init__(self, path, sync_interval=0.2, history=2000):
+        # settings
+        self.path = path
+        self.sync_interval = sync_interval
+        self.history = history
+
+        # state
+        self._lock = _lock(path + '.lock')
+        self._file = open(path, 'ab')
+        self._records = []
+        self._condition = threading.Condition()
+        self._closed = False
+        # Offsets in the file of the entries not yet settled, and of the
+        # latest settled ones with the offsets of their status records.
+        self._unsettled = collections.deque()
+        self._settled = collections.deque()
+        # Status record offsets, in order, of entries older than those.
+        self._before = []
+        self._start = None
+        self._replayed = False
+        self._thread = threading.Thread(target=self._run, name="Journal", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def read(path, repair=False):
+        """
+        Yields the records in the journal at path, reading it a line at a
+        time. A line cut short by a crash ends the journal, and with repair
+        it is removed so that writing can carry on after it.
+        """
+        for _, record in Journal._scan(path, repair):
+            yield record
+
+    @staticmethod
+    def _scan(path, repair=False, offset=0):
+        """Yields (offset, record) for the records from offset on, as read() does."""
+        try:
+            f = open(path, 'r+b' if repair else 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            good = offset
+            for line in f:
+                try:
+                    record = json.loads(line.decode('UTF-8'))
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                yield good, record
+                good += len(line)
+            if repair:
+                f.truncate(good)
+
+    def replay(self):
+        """
+        Yields the records a client needs to carry on: those from the saved
+        start on, with status records for entries before it left out.
+        Repairs the end of the file. Call it once, before adding records.
+        """
+        offset, skip = 0, 0
+        try:
+            with open(self.path + '.start') as f:
+                offset, skip = json.load(f)
+            with open(self.path, 'rb') as f:
+                # It must point just past the end of a line.
+                f.seek(max(offset - 1, 0))
+                if offset and f.read(1) != b'\n':
+                    offset, skip = 0, 0
+        except (OSError, ValueError, TypeError):
+            offset, skip = 0, 0
+        self._replayed = True
+        for position, record in Journal._scan(self.path, True, offset):
+            if record[0] == 'e':
+                self._unsettled.append(position)
+            else:
+                count = record[1]
+                skipped = min(skip, count)
+                skip -= skipped
+                count -= skipped
+                self._before.extend([position] * skipped)
+                if not count:
+                    continue
+                self._settle(count, position)
+                record = ['s', count, record[2]]
+            yield record
+
+    def _settle(self, count, position):
+        for _ in range(min(count, len(self._unsettled))):
+            self._settled.append((self._unsettled.popleft(), position))
+            if len(self._settled) > self.history:
+                bisect.insort(self._before, self._settled.popleft()[1])
+
+    def _where(self, end):
+        """Returns the saved start: an offset, and how many settled entries before it have status records after it."""
+        if self._settled:
+            offset = self._settled[0][0]
+        elif self._unsettled:
+            offset = self._unsettled[0]
+        else:
+            offset = end
+        del self._before[:bisect.bisect_left(self._before, offset)]
+        return [offset, len(self._before)]
+
+    def entries(self, items):
+        """Records new entries."""
+        self._add(('e', item.time, item.text) for item in items)
+
+    def status(self, count, status):
+        """Records the final status of the oldest count unsettled entries."""
+        self._add([('s', count, status)])
+
+    def _add(self, records):
+        with self._condition:
+            notify = not self._records
+            self._records.extend(records)
+            if notify:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._records and not self._closed:
+                    self._condition.wait()
+                closed = self._closed
+            if not closed:
+                # Let more records gather so one sync covers them all.
+                time.sleep(self.sync_interval)
+            with self._condition:
+                records, self._records = self._records, []
+            if records:
+                position = self._file.seek(0, os.SEEK_END)
+                lines = []
+                for kind, a, b in records:
+                    if kind == 'e':
+                        self._unsettled.append(position)
+                        a = wallclock(a).isoformat(timespec='microseconds')
+                    else:
+                        self._settle(a, position)
+                    lines.append(json.dumps([kind, a, b]).encode('UTF-8') + b'\n')
+                    position += len(lines[-1])
+                self._file.write(b''.join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                # Only once the records it points past are on disk.
+                start = self._where(position)
+                if start != self._start:
+                    self._start = start
+                    with open(self.path + '.start.tmp', 'w') as f:
+                        json.dump(start, f)
+                    os.replace(self.path + '.start.tmp', self.path + '.start')
+            if closed:
+                return
+
+    def close(self, retire=False):
+        """
+        Writes out what is left and closes the file. With retire, a journal
+        whose entries are all settled is renamed with the date and time,
+        so the next one starts a new session.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._file.close()
+        if retire and self._replayed and not self._unsettled:
+            try:
+                os.remove(self.path + '.start')
+            except FileNotFoundError:
+                pass
+            if os.path.getsize(self.path):
+                base, ext = os.path.splitext(self.path)
+                base += datetime.datetime.now().strftime('-%Y%m%d-%H%M%S')
+                name = base + ext
+                for n in itertools.count(2):
+                    if not os.path.exists(name):
+                        break
+                    name = '{base}-{n}{ext}'.format(base=base, n=n, ext=ext)
+                os.rename(self.path, name)
+            else:
+                os.remove(self.path)
+        self._lock.close()
+
+def _cues(records, max_length=84, max_gap=3):
+    """
+    Groups the entries among journal records into captions of up to
+    max_length characters, starting a new one after a pause of max_gap
+    seconds, a newline or the end of a sentence. Yields (start, text).
+    """
+    start = None
+    last = None
+    text = ''
+    for record in records:
+        if record[0] != 'e':
+            continue
+        when = datetime.datetime.fromisoformat(record[1])
+        piece = record[2]
+        if start is not None and (
+                (when - last).total_seconds() > max_gap or
+                len(text) + len(piece) > max_length or
+                text.endswith('\n') or
+                text.rstrip()[-1:] in ('.', '?', '!') and len(text) > max_length // 3):
+            if text.strip():
+                yield start, text.strip()
+            start = None
+            text = ''
+        if start is None:
+            start = when
+        text += piece
+        last = when
+    if start is not None and text.strip():
+        yield start, text.strip()
+
+def export(path, out, format='srt', start=None, max_duration=5, min_duration=1):
+    """
+    Writes the transcript in the journal at path to the text file out as
+    SRT or WebVTT subtitles. Times are relative to start, a UTC datetime,
+    or to the first entry. Each cue is shown for at least min_duration
+    seconds, and one that would start sooner after the one before waits
+    for it, as players may drop cues that end as they start. The journal
+    is read a line at a time.
+    """
+    def stamp(when):
+        ms = max(int((when - start).total_seconds() * 1000), 0)
+        hours, ms = divmod(ms, 3600000)
+        minutes, ms = divmod(ms, 60000)
+        seconds, ms = divmod(ms, 1000)
+        return "{:02d}:{:02d}:{:02d}{}{:03d}".format(hours, minutes, seconds, ',' if format == 'srt' else '.', ms)
+
+    if format == 'vtt':
+        out.write("WEBVTT\n\n")
+    previous = None
+    shown = None # when the last cue written ends
+    number = 0
+    cues = _cues(Journal.read(path))
+    for cue in itertools.chain(cues, [None]):
+        if previous is not None:
+            begin, text = previous
+            if start is None:
+                start = begin
+            if shown is not None:
+                begin = max(begin, shown)
+            end = begin + datetime.timedelta(seconds=max_duration)
+            if cue is not None:
+                end = min(end, cue[0])
+            end = shown = max(end, begin + datetime.timedelta(seconds=min_duration))
+            number += 1
+            if format == 'srt':
+                out.write("{}\n".format(number))
+            lines = textwrap.wrap(text, max(len(text) // 2 + 1, 42)) or [text]
+            out.write("{} --> {}\n{}\n\n".format(stamp(begin), stamp(end), '\n'.join(lines)))
+        previous = cue
+
+_cue_time = re.compile(r'(?:(\d+):)?(\d\d):(\d\d)[,.](\d{3})\s*-->')
+_cue_tag = re.compile(r'<[^>]*>')
+
+def _subtitles(lines):
+    """Yields (seconds, text) for each cue in the lines of an SRT or WebVTT file."""
+    when = None
+    text = []
+    for line in itertools.chain(lines, ['']):
+        line = line.strip().lstrip('\ufeff')
+        if not line:
+            if when is not None and text:
+                yield when, ' '.join(text)
+            when = None
+            text = []
+            continue
+        match = _cue_time.match(line)
+        if match:
+            hours, minutes, seconds, ms = (int(group or 0) for group in match.groups())
+            when = hours * 3600 + minutes * 60 + seconds + ms / 1000
+            text = []
+        elif when is not None:
+            text.append(_cue_tag.sub('', line))
+
+def _transcript_format(path):
+    """Guesses the format of a transcript file from its name."""
+    format = os.path.splitext(path)[1].lstrip('.').lower()
+    return format if format in ('srt', 'vtt') else 'journal'
+
+def transcript(path, format=None, start=None):
+    """
+    Yields the captions in an SRT or WebVTT file, or a journal, as
+    TextEntry items, reading one line at a time. The format is guessed
+    from the file name unless given. Subtitle times are taken from start, a
+    UTC datetime, or from now; a journal keeps its times unless start is
+    given, when its first entry is moved to start. Each cue ends with a
+    newline, so exporting the result gives the same cues back.
+    """
+    format = format or _transcript_format(path)
+    if format == 'journal':
+        shift = None
+        for record in Journal.read(path):
+            if record[0] != 'e':
+                continue
+            when = datetime.datetime.fromisoformat(record[1])
+            if shift is None:
+                shift = start - when if start else datetime.timedelta()
+            yield TextEntry(record[2], monotonic(when + shift))
+        return
+    start = start or datetime.datetime.utcnow()
+    with open(path, encoding='UTF-8', errors='replace') as f:
+        for seconds, text in _subtitles(f):
+            yield TextEntry(text + '\n', monotonic(start + datetime.timedelta(seconds=seconds)))
+
+class TransportError(Exception):
+    pass
+
+class Transport:
+    """
+    Keep-alive HTTP(S) connections to the ingestion host, reused across
+    posts. A pooled connection the server has since closed is replaced and
+    the request retried once.
+    """
+    def __init__(self):
+        self.connect_timeout = 5
+        self.pool_size = 4
+        self._lock = threading.Lock()
+        self._idle = []
+        self._target = None
+        self._warm_failed = None
+
+    def _split(self, url):
+        try:
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port
+        except ValueError:
+            parts = port = None
+        if not parts or parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise TransportError("invalid url: {url}".format(url=url))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        # Characters http.client won't send are escaped, leaving those
+        # already escaped and the URL's delimiters alone.
+        path = urllib.parse.quote(path, safe="!#$%&'()*+,/:;=?@[]~")
+        return (parts.scheme, parts.hostname, port), path
+
+    def _connect(self, target, timeout):
+        scheme, host, port = target
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = cls(host, port, timeout=timeout)
+        try:
+            conn.connect()
+        except OSError:
+            conn.close()
+            raise
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _acquire(self, target):
+        """Returns an idle connection to target, or None."""
+        with self._lock:
+            if target != self._target:
+                for conn in self._idle:
+                    conn.close()
+                self._idle.clear()
+                self._target = target
+            return self._idle.pop() if self._idle else None
+
+    def _release(self, target, conn):
+        with self._lock:
+            if target == self._target and len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def warm(self, url):
+        """
+        Opens a connection to url's host ahead of the first post, so the
+        TCP and TLS handshakes don't count against the post timeout.
+        """
+        try:
+            target, _ = self._split(url)
+        except TransportError:
+            return
+        with self._lock:
+            if target == self._target and self._idle or target == self._warm_failed:
+                return
+        try:
+            conn = self._connect(target, self.connect_timeout)
+        except OSError:
+            self._warm_failed = target
+            return
+        self._warm_failed = None
+        # Acquiring points the pool at target; a connection a post has
+        # released meanwhile goes back alongside the new one.
+        idle = self._acquire(target)
+        if idle is not None:
+            self._release(target, idle)
+        self._release(target, conn)
+
+    def post(self, url, body, headers, timeout):
+        """Posts body to url and returns the response text."""
+        target, path = self._split(url)
+        conn = self._acquire(target)
+        reused = conn is not None
+        while True:
+            try:
+                if conn is None:
+                    conn = self._connect(target, timeout)
+                else:
+                    conn.sock.settimeout(timeout)
+                conn.request('POST', path, body, headers)
+                response = conn.getresponse()
+                text = response.read().decode('UTF-8')
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                # conn is None if connecting failed, as when a TLS handshake is reset.
+                if conn is not None:
+                    conn.close()
+                if not reused:
+                    raise TransportError(e) from e
+                # The server closed an idle connection; try a fresh one.
+                conn = None
+                reused = False
+                continue
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                # ValueError covers a host or header http.client can't encode.
+                if conn is not None:
+                    conn.close()
+                raise TransportError(e) from e
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(target, conn)
+        if not 200 <= response.status < 300:
+            raise TransportError("{status} {reason}".format(status=response.status, reason=response.reason))
+        return text
+
+class ClockSync:
+    """
+    Estimates how far the server's clock is ahead of ours from the times in
+    post replies, the way NTP does. Each reply is compared with the middle
+    of its round trip, so the true offset lies within half the round trip of
+    the sample. The sample with the shortest round trip among the recent
+    ones is trusted, samples far off the current estimate are dropped as
+    spikes, and drift is fitted to the trusted samples over time.
+    """
+    def __init__(self):
+        # constants
+        self._filter = 8 # recent samples the best is picked from
+        self._resolution = 0.001 # the server reports milliseconds
+        self._max_drift = 15e-6 # assumed frequency error between fits, in s/s
+        self._min_span = 60 # seconds of trusted samples before drift is fitted
+        self._max_rejects = 4 # spikes in a row before believing the clock moved
+
+        # state
+        self._samples = collections.deque(maxlen=self._filter) # (time, offset, delay)
+        self._trusted = collections.deque(maxlen=16)
+        self._rejects = 0
+        self._time = None # monotonic ns of the trusted sample
+        self._offset = 0.0
+        self._delay = 0.0
+        self._drift = 0.0
+        self._fitted = False
+        self._jitter = 0.0
+        self._lock = threading.Lock()
+
+    def sample(self, sent, received, server):
+        """
+        Records a reply stamped server, a UTC datetime, to a request sent and
+        answered at the given time.monotonic_ns() values.
+        """
+        delay = (received - sent) / 1e9
+        time = sent + (received - sent) // 2
+        # The server truncates, so its clock is on average half a tick on.
+        offset = (server - wallclock(time)).total_seconds() + self._resolution / 2
+        with self._lock:
+            if self._time is not None:
+                tolerance = delay / 2 + self._error(time) + 3 * self._jitter
+                if abs(offset - self._predict(time)) > tolerance and self._rejects < self._max_rejects:
+                    self._rejects += 1
+                    return
+            self._rejects = 0
+            self._samples.append((time, offset, delay))
+            # Jitter is measured among the quicker half of the samples, those
+            # the estimate could come from; a slow one is off by its delay.
+            quick = sorted(self._samples, key=lambda sample: sample[2])[:(len(self._samples) + 1) // 2]
+            best = quick[0]
+            self._jitter = (sum((sample[1] - best[1]) ** 2 for sample in quick) / len(quick)) ** 0.5
+            if self._time is not None and best[0] <= self._time:
+                return
+            self._time, self._offset, self._delay = best
+            self._trusted.append(best)
+            self._fit()
+
+    def _fit(self):
+        """Fits the drift to the trusted samples by least squares."""
+        first = self._trusted[0][0]
+        if (self._time - first) / 1e9 < self._min_span:
+            return
+        xs = [(sample[0] - first) / 1e9 for sample in self._trusted]
+        ys = [sample[1] for sample in self._trusted]
+        mx = sum(xs) / len(xs)
+        my = sum(ys) / len(ys)
+        var = sum((x - mx) ** 2 for x in xs)
+        if var:
+            drift = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+            # No real clock is this far out; a bigger slope is noise.
+            self._drift = max(-500e-6, min(500e-6, drift))
+            self._fitted = True
+
+    def _predict(self, now):
+        return self._offset + self._drift * (now - self._time) / 1e9
+
+    def _error(self, now):
+        return self._delay / 2 + self._resolution + self._max_drift * abs(now - self._time) / 1e9
+
+    def correction(self, now):
+        """
+        Returns the timedelta to add to our UTC time at time.monotonic_ns()
+        now to get the server's, to the millisecond.
+        """
+        with self._lock:
+            if self._time is None:
+                return datetime.timedelta()
+            return datetime.timedelta(milliseconds=round(self._predict(now) * 1000))
+
+    def error(self, now):
+        """
+        Returns the bound, in seconds, on the error of correction(now), or
+        ``None`` before the first reply.
+        """
+        with self._lock:
+            if self._time is None:
+                return None
+            return self._error(now) + self._jitter
+
+    def expires(self, now, tolerance):
+        """
+        Returns the seconds from time.monotonic_ns() now until error() grows
+        past tolerance. It is 0 once it has, and until drift has been
+        fitted, while every sample still helps.
+        """
+        with self._lock:
+            if self._time is None or not self._fitted:
+                return 0
+            return max(tolerance - self._error(now) - self._jitter, 0) / self._max_drift
+
+class Timer:
+    """A callback scheduled on a :class:`Scheduler`."""
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """
+    Runs callbacks at given clock.monotonic() times on one background thread.
+    Timers are kept in a heap and the thread sleeps until the earliest one
+    is due or a new one is added, so it uses no CPU while there is nothing
+    to do.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, clock=time):
+        # Anything with monotonic() and monotonic_ns() like the time module.
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the scheduler shared by everything in the process that
+        doesn't bring its own, started on first use. It runs until exit.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = Scheduler()
+                cls._shared.start()
+            return cls._shared
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="Scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            with self._condition:
+                thread, self._thread = self._thread, None
+                self._condition.notify()
+            thread.join()
+
+    def call_at(self, when, fn, *args):
+        """Calls fn(*args) on the scheduler thread at when. Safe to call from any thread."""
+        timer = Timer(when, fn, args)
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), timer))
+            if self._heap[0][2] is timer:
+                self._condition.notify()
+        return timer
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(self.clock.monotonic() + delay, fn, *args)
+
+    def call_soon(self, fn, *args):
+        return self.call_at(self.clock.monotonic(), fn, *args)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._thread is None:
+                        return
+                    if self._heap:
+                        wait = self._heap[0][0] - self.clock.monotonic()
+                        if wait <= 0:
+                            _, _, timer = heapq.heappop(self._heap)
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+            if timer.cancelled:
+                continue
+            try:
+                timer.fn(*timer.args)
+            except Exception:
+                traceback.print_exc()
+
+class Counter:
+    """A count that only goes up."""
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge:
+    """A value that is read, by calling fn, only when metrics are collected."""
+    kind = 'gauge'
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def snapshot(self):
+        return self.fn()
+
+class Histogram:
+    """
+    Counts observations in buckets with fixed upper bounds, by default
+    growing by a factor of sqrt(2) from 0.1 ms to about 100 s, so recording
+    one is a bisection and an increment.
+    """
+    kind = 'histogram'
+    bounds = tuple(float('{:.3g}'.format(0.0001 * 2 ** (i / 2))) for i in range(41))
+
+    def __init__(self, bounds=None):
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self._lock = threading.Lock()
+
+    def observe(self, value, count=1):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += count
+            self.sum += value * count
+            self.count += count
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates quantile q, interpolating linearly within the bucket that
+        holds it and the values seen there, or returns None if empty.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = float('-inf')
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            if count and seen + count >= rank:
+                low, high = max(lower, self.min), min(bound, self.max)
+                return low + (high - low) * max(rank - seen, 0) / count
+            seen += count
+            lower = bound
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            count, total = self.count, self.sum
+        return {
+            'count': count,
+            'sum': total,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+class Metrics:
+    """
+    Named counters, gauges and histograms, each optionally with labels.
+    They can be written periodically to a JSON-lines file or served in the
+    Prometheus text format.
+    """
+    def __init__(self):
+        self._metrics = collections.OrderedDict() # (name, labels) -> metric
+        self._help = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(*args)
+                self._help[name] = help
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, bounds=None, **labels):
+        return self._get(Histogram, name, help, labels, bounds)
+
+    def gauge(self, name, help, fn, **labels):
+        """Registers fn, called when metrics are collected, as the gauge's value."""
+        gauge = self._get(Gauge, name, help, labels, fn)
+        gauge.fn = fn
+        return gauge
+
+    def remove(self, **labels):
+        """Removes every metric that has the given labels."""
+        items = tuple(labels.items())
+        with self._lock:
+            for key in [key for key in self._metrics if all(item in key[1] for item in items)]:
+                del self._metrics[key]
+
+    def snapshot(self):
+        """Returns the current values, keyed by name and labels."""
+        with self._lock:
+            metrics = list(self._metrics.items())
+        values = {}
+        for (name, labels), metric in metrics:
+            if labels:
+                name += '{' + ','.join('{k}="{v}"'.format(k=k, v=v) for k, v in labels) + '}'
+            try:
+                values[name] = metric.snapshot()
+            except Exception:
+                values[name] = None
+        return values
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.items())
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(metrics, key=lambda item: item[0][0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP {name} {help}'.format(name=name, help=self._help[name]))
+                lines.append('# TYPE {name} {kind}'.format(name=name, kind=metric.kind))
+            def series(suffix, value, extra=()):
+                pairs = list(labels) + list(extra)
+                label = '{' + ','.join('{k}="{v}"'.format(k=k, v=v) for k, v in pairs) + '}' if pairs else ''
+                lines.append('{name}{suffix}{label} {value}'.format(name=name, suffix=suffix, label=label, value=value))
+            if metric.kind == 'histogram':
+                with metric._lock:
+                    counts, total, count = list(metric.counts), metric.sum, metric.count
+                cumulative = 0
+                for bound, n in zip(metric.bounds, counts):
+                    cumulative += n
+                    series('_bucket', cumulative, [('le', '{:g}'.format(bound))])
+                series('_bucket', count, [('le', '+Inf')])
+                series('_sum', total)
+                series('_count', count)
+            else:
+                try:
+                    value = metric.snapshot()
+                except Exception:
+                    continue
+                if value is not None:
+                    series('', value)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, f):
+        """Appends a snapshot to the text file f as one JSON line."""
+        record = {'time': datetime.datetime.utcnow().isoformat(timespec='milliseconds'), 'metrics': self.snapshot()}
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves the metrics for Prometheus at http://host:port/metrics on a thread of its own."""
+        metrics = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), handler)
+        threading.Thread(target=self._server.serve_forever, name="Metrics", daemon=True).start()
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+class Payload:
+    """
+    The body of one post: a timestamp line and a text line per entry. Each
+    entry's text is encoded once as it is added. The timestamps are
+    rendered from the entry times plus a shift, the clock correction and
+    offset, and the body is only assembled again when the shift changes,
+    so retries send the same buffer.
+    """
+    # Each entry costs a timestamp line of this many bytes, and a newline
+    # after its text.
+    overhead = len('2000-01-01T00:00:00.000\n') + 1
+
+    def __init__(self):
+        self._times = []
+        self._texts = []
+        self._shift = None
+        self._body = None
+        self.size = 0
+
+    def __len__(self):
+        return len(self._times)
+
+    @staticmethod
+    def encode(text):
+        """Returns text as it is sent."""
+        return text.replace("\n", "<br>").encode('UTF-8')
+
+    def add(self, time, data):
+        """Adds an entry given its time and encoded text."""
+        self._times.append(time)
+        self._texts.append(data)
+        self.size += self.overhead + len(data)
+        self._body = None
+
+    def body(self, shift):
+        """Returns the body with every time moved by the timedelta shift."""
+        if self._body is None or shift != self._shift:
+            start = _wallclock_base + shift
+            first = start.replace(microsecond=0)
+            lines = []
+            second = None
+            for ns, data in zip(self._times, self._texts):
+                # Entries mostly share their second with the one before, so
+                # only the milliseconds need formatting.
+                seconds, micros = divmod(start.microsecond + (ns - _monotonic_base) // 1000, 1000000)
+                if seconds != second:
+                    second = seconds
+                    when = first + datetime.timedelta(seconds=seconds)
+                    prefix = b'%04d-%02d-%02dT%02d:%02d:%02d.' % (when.year, when.month, when.day, when.hour, when.minute, when.second)
+                lines.append(prefix + b'%03d' % (micros // 1000))
+                lines.append(data)
+            lines.append(b'')
+            self._body = b'\n'.join(lines)
+            self._shift = shift
+        return self._body
+
+class _Batch:
+    """Entries posted together under one sequence number."""
+    def __init__(self, seq, items, payload, now):
+        self.seq = seq
+        self.items = items
+        self.payload = payload
+        self.start = now
+        self.delay = 0.1
+        self.next_attempt = now
+        self.posting = False
+        self.attempts = 0
+        self.status = None
+        # Where the entries' text lies in the client's spans, if primary.
+        self.span = None
+
+class Destination:
+    """
+    One ingestion URL fed by a Client, with its own queue, sequence numbers,
+    retries, connections and clock estimate, so a slow or failing URL never
+    holds back the others. Only the primary destination sets the status of
+    entries. Until it has a usable URL, as when the app starts before one is
+    pasted in, entries wait in its queue and nothing is posted. A backup
+    keeps at most the client's backup_pending entries waiting, dropping the
+    oldest, so one that is down or has a bad URL doesn't hold the session.
+    """
+    def __init__(self, client, url='', primary=False, name='primary'):
+        # constants
+        self._warm_delay = 1
+        self._post_timeout = 0.2
+
+        # state
+        self._client = client
+        self._clock = client._clock
+        self._pending = collections.deque()
+        self._seq = 0
+        self._batches = collections.OrderedDict() # seq -> _Batch, oldest first
+        self._heartbeat_posting = False
+        self._heartbeat_due = None # None until worked out after the last post
+        # Longest gap between posts while heartbeats keep getting through.
+        self._heartbeat_ceiling = 0
+        self._last_post = self._clock.monotonic()
+        self._transport = client._transport_factory()
+        self._scheduler = None
+        self._executor = None
+        self._timer = None
+        self._warm_timer = None
+        self._url = url
+        self._usable = self._check(url)
+        self.primary = primary
+        self.name = name
+        metrics = client.metrics
+        self._rtt = metrics.histogram('caption_post_rtt_seconds', "Round-trip time of posts", destination=name)
+        self._successes = metrics.counter('caption_posts_total', "Posts made", destination=name, result='success')
+        self._failures = metrics.counter('caption_posts_total', "Posts made", destination=name, result='failure')
+        self._retries = metrics.counter('caption_retries_total', "Posts of a batch after its first", destination=name)
+        self._failed = metrics.counter('caption_failed_batches_total', "Batches given up on", destination=name)
+        self._dropped = metrics.counter('caption_dropped_entries_total', "Entries a backup dropped unsent", destination=name)
+        self._attempts = metrics.histogram('caption_batch_attempts', "Posts needed to settle each batch", (1, 2, 3, 4, 6, 8, 12, 16), destination=name)
+        metrics.gauge('caption_clock_correction_seconds', "Estimated server clock offset", lambda: self.clock.correction(self._clock.monotonic_ns()).total_seconds(), destination=name)
+        metrics.gauge('caption_clock_error_seconds', "Bound on the clock offset error", lambda: self.clock.error(self._clock.monotonic_ns()), destination=name)
+        # Tracks the server's clock from post replies.
+        self.clock = ClockSync()
+        # Moving average of post round-trip times, in seconds.
+        self.rtt = 0.0
+        # Whether the last post succeeded, or None before the first.
+        self.connected = None
+
+    @property
+    def url(self):
+        return self._url
+
+    @url.setter
+    def url(self, url):
+        self._url = url
+        self._usable = self._check(url)
+        if self._executor:
+            # Warm up a connection once the URL stops changing.
+            if self._warm_timer:
+                self._warm_timer.cancel()
+            self._warm_timer = self._scheduler.call_later(self._warm_delay, self._executor.submit, self._transport.warm, url)
+            # Anything waiting for a URL can go now.
+            self._scheduler.call_soon(self._update)
+
+    @staticmethod
+    def _check(url):
+        """Returns whether url is one posts can be made to."""
+        try:
+            parts = urllib.parse.urlsplit(url)
+        except ValueError:
+            return False
+        return parts.scheme in ('http', 'https') and bool(parts.hostname)
+
+    def start(self, scheduler):
+        self._scheduler = scheduler
+        window = self._client.window
+        self._transport.pool_size = window + 1
+        self._executor = self._client._executor_factory(window + 1)
+        self.url = self._url
+        self._heartbeat_ceiling = self._client.heartbeat_min
+        self._last_post = self._clock.monotonic()
+        # The first heartbeats of sessions started together are spread out.
+        self._heartbeat_due = self._clock.monotonic() + self._client._rng.uniform(0, 1)
+        self._scheduler.call_soon(self._update)
+
+    def stop(self):
+        if self._executor:
+            for timer in (self._timer, self._warm_timer):
+                if timer:
+                    timer.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _completed(self, batch, success):
+        """Records the result of posting batch."""
+        client = self._client
+        now = self._clock.monotonic()
+        with client.lock:
+            batch.posting = False
+            if success:
+                batch.status = TextEntry.SUCCESS
+                if self.primary:
+                    ns = self._clock.monotonic_ns()
+                    for item in batch.items:
+                        client._ack_latency.observe((ns - item.time) / 1e9)
+            elif now - batch.start >= client.retry_timeout:
+                batch.status = TextEntry.FAILED
+                self._failed.inc()
+            else:
+                # Each batch backs off on its own, so one slow sequence doesn't
+                # hold back the ones behind it.
+                batch.delay *= 2
+                batch.next_attempt = now + client._rng.uniform(0, batch.delay)
+            changes = []
+            if batch.status is not None:
+                self._attempts.observe(batch.attempts)
+                if self.primary:
+                    for item in batch.items:
+                        item.status = batch.status
+                    client.spans.set(*batch.span, batch.status)
+                    changes.append(batch.span + (batch.status,))
+            # Batches leave the window in sequence order.
+            while self._batches:
+                seq, first = next(iter(self._batches.items()))
+                if first.status is None:
+                    break
+                del self._batches[seq]
+                if self.primary:
+                    changes += client._confirm(first.items, first.status)
+        self._heartbeat_due = None
+        client.post_callback(self, success)
+        if changes:
+            client.change_callback(changes)
+        self._update()
+
+    def _heartbeat_completed(self, success):
+        client = self._client
+        # Heartbeats find out how long the endpoint can be left: the gap
+        # grows a second at a time while they succeed and halves when one
+        # fails.
+        if success:
+            self._heartbeat_ceiling = min(self._heartbeat_ceiling + 1, client.heartbeat_max)
+        else:
+            self._heartbeat_ceiling = max(self._heartbeat_ceiling / 2, client.heartbeat_min)
+        self._heartbeat_posting = False
+        self._heartbeat_due = None
+        client.post_callback(self, success)
+        self._update()
+
+    def _heartbeat_interval(self):
+        """
+        Returns the seconds to leave after a post before a heartbeat: as long
+        as the endpoint is known to allow, but sooner if the clock estimate
+        needs a sample to stay within clock_tolerance.
+        """
+        client = self._client
+        expires = self.clock.expires(self._clock.monotonic_ns(), client.clock_tolerance)
+        return max(client.heartbeat_min, min(self._heartbeat_ceiling, expires))
+
+    def _submit(self, seq, payload, callback):
+        future = self._executor.submit(self._post, seq, payload)
+        future.add_done_callback(lambda f: self._scheduler.call_soon(callback, f.exception() is None and f.result()))
+
+    def _update(self):
+        """
+        Starts whatever posts are due and sets a timer for the next deadline:
+        a retry backing off or the heartbeat. Runs on the scheduler thread
+        whenever something changes; posts run on a pool of threads.
+
+        Captions posts stand in for heartbeats, so a heartbeat is only sent
+        after a quiet spell. Each one comes up to a fifth of the interval
+        early, drawn afresh every time, so the heartbeats of sessions
+        sharing a scheduler don't line up.
+        """
+        if not self._executor:
+            return
+        client = self._client
+        now = self._clock.monotonic()
+        deadline = None
+        changes = []
+        usable = self._usable
+        with client.lock:
+            while usable and self._pending and len(self._batches) < client.window:
+                items = []
+                payload = Payload()
+                while self._pending and len(items) < client.batch_entries:
+                    item = self._pending[0]
+                    data = Payload.encode(item.text)
+                    if items and payload.size + Payload.overhead + len(data) > client.batch_bytes:
+                        break
+                    items.append(self._pending.popleft())
+                    payload.add(item.time, data)
+                self._seq += 1
+                batch = _Batch(self._seq, items, payload, now)
+                if self.primary:
+                    ns = self._clock.monotonic_ns()
+                    length = 0
+                    for item in batch.items:
+                        item.status = TextEntry.SENT
+                        length += len(item.text)
+                        client._post_latency.observe((ns - item.time) / 1e9)
+                    client._sent.extend(batch.items)
+                    batch.span = (client._unsent, client._unsent + length)
+                    client._unsent += length
+                    client.spans.set(*batch.span, TextEntry.SENT)
+                    if changes and changes[-1][1] == batch.span[0]:
+                        changes[-1] = (changes[-1][0], batch.span[1], TextEntry.SENT)
+                    else:
+                        changes.append(batch.span + (TextEntry.SENT,))
+                self._batches[batch.seq] = batch
+            for batch in self._batches.values():
+                if batch.posting or batch.status is not None:
+                    continue
+                if not usable:
+                    # The URL was cleared; the retry clock waits for a new one.
+                    batch.start = batch.next_attempt = now
+                elif now >= batch.next_attempt:
+                    batch.posting = True
+                    batch.attempts += 1
+                    if batch.attempts > 1:
+                        self._retries.inc()
+                    self._submit(batch.seq, batch.payload, functools.partial(self._completed, batch))
+                else:
+                    deadline = batch.next_attempt if deadline is None else min(deadline, batch.next_attempt)
+        if changes:
+            client.change_callback(changes)
+        if usable and not self._batches and not self._heartbeat_posting:
+            if self._heartbeat_due is None:
+                interval = self._heartbeat_interval()
+                self._heartbeat_due = self._last_post + interval - client._rng.uniform(0, interval / 5)
+            heartbeat = self._heartbeat_due
+            if now >= heartbeat:
+                self._seq += 1
+                self._heartbeat_posting = True
+                payload = Payload()
+                payload.add(self._clock.monotonic_ns(), b'')
+                self._submit(self._seq, payload, self._heartbeat_completed)
+            else:
+                deadline = heartbeat if deadline is None else min(deadline, heartbeat)
+        if self._timer and (deadline is None or self._timer.when != deadline or self._timer.when <= now):
+            self._timer.cancel()
+            self._timer = None
+        if deadline is not None and self._timer is None:
+            self._timer = self._scheduler.call_at(deadline, self._update)
+
+    def _post(self, seq, payload):
+        headers = {'content-type': 'text/plain'}
+        data = payload.body(self._client.offset + self.clock.correction(self._clock.monotonic_ns()))
+        try:
+            sent = self._clock.monotonic_ns()
+            text = self._transport.post(self.url + "&seq={seq}".format(seq=seq), data, headers, self._post_timeout)
+            received = self._clock.monotonic_ns()
+            self.rtt = 0.8 * self.rtt + 0.2 * (received - sent) / 1e9
+            self._rtt.observe((received - sent) / 1e9)
+            self._successes.inc()
+            success = True
+        except TransportError:
+            self._failures.inc()
+            success = False
+        finally:
+            # Even a post that raised is one, or heartbeats would follow
+            # each other without a pause.
+            self._last_post = self._clock.monotonic()
+        if success:
+            try:
+                server = datetime.datetime.fromisoformat(text.strip())
+            except ValueError:
+                pass
+            else:
+                self.clock.sample(sent, received, server)
+        self.connected = success
+        return success
+
+class Client:
+    """
+    Sends entries to one or more ingestion URLs. The first URL is the
+    primary: entry statuses and the history follow its posts. The others,
+    such as a backup ingestion URL or an archive, get the same entries
+    through destinations of their own.
+
+    Everything that depends on the outside world can be replaced, so the
+    client can run in simulated time: the scheduler and its clock, the
+    random numbers used for backoff, the transport each destination posts
+    with, and the executor that runs the posts. Clients not given a
+    scheduler share one, so a process runs many sessions on one thread.
+    """
+    def __init__(self, scheduler=None, rng=random, transport=Transport, executor=None):
+        # state
+        self._confirmed = collections.deque()
+        self._sent = collections.deque()
+        # Status of the text of the entries above, as runs. Read it, like
+        # entries(), holding lock.
+        self.spans = StatusSpans()
+        self._unsent = 0 # where the primary's unsent text starts in spans
+        self._archive = None
+        self._journal = None
+        self._scheduler = scheduler or Scheduler.shared()
+        self._clock = self._scheduler.clock
+        self._rng = rng
+        self._transport_factory = transport
+        self._executor_factory = executor or (lambda workers: concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Post"))
+        self._running = False
+        self._metrics_file = None
+        self._metrics_timer = None
+        # Held while entries move between states. Readers of entries() on
+        # other threads must hold it too.
+        self.lock = threading.RLock()
+        self.metrics = Metrics()
+        self._release_latency = self.metrics.histogram('caption_release_seconds', "Time from typing an entry to its release")
+        self._post_latency = self.metrics.histogram('caption_post_seconds', "Time from typing an entry to its first post")
+        self._ack_latency = self.metrics.histogram('caption_ack_seconds', "Time from typing an entry to its acknowledgement")
+        self.metrics.gauge('caption_entries', "Entries held by state", lambda: len(self.destinations[0]._pending), state='pending')
+        self.metrics.gauge('caption_entries', "Entries held by state", lambda: len(self._sent), state='sent')
+        self.metrics.gauge('caption_entries', "Entries held by state", lambda: len(self._confirmed), state='confirmed')
+        self.destinations = [Destination(self, primary=True)]
+
+        # settings
+        # Called, on the scheduler thread, with the destination and whether
+        # its post succeeded.
+        self.post_callback = lambda destination, success: None
+        # Called, on the scheduler thread, whenever entries are added, change
+        # status or are dropped from memory, with a list of (start, end,
+        # status) ranges of spans in the order they changed. Added text
+        # comes as a range past the previous end, and dropped text as a
+        # range at the start with a status of None.
+        self.change_callback = lambda changes: None
+        self.offset = datetime.timedelta()
+        # Number of batches that may be in flight at once, per destination.
+        self.window = 4
+        # Limits on the size of one post.
+        self.batch_entries = 200
+        self.batch_bytes = 8192
+        # Most entries a backup holds waiting to be posted before dropping
+        # the oldest.
+        self.backup_pending = 2000
+        # Seconds a batch is retried for before its entries are given up on.
+        self.retry_timeout = 5
+        # When there are no captions to post, a heartbeat keeps the stream
+        # alive and the clock estimate fresh. It follows the last post by
+        # heartbeat_min seconds at first, stretching towards heartbeat_max
+        # while heartbeats get through and the clock estimate stays within
+        # clock_tolerance seconds.
+        self.heartbeat_min = 5
+        self.heartbeat_max = 20
+        self.clock_tolerance = 0.1
+        # Confirmed entries beyond the newest history_size, or older than
+        # history_age seconds, are moved to the archive a batch at a time so the
+        # display only has to drop text occasionally.
+        self.history_size = 2000
+        self.history_age = 30 * 60
+        self.history_batch = 200
+        self.archive_path = None
+        # With archive False, entries leaving the history are forgotten.
+        self.archive = True
+        # Journal of everything sent. When it already exists, starting
+        # picks up where it left off: the history is restored and entries
+        # that weren't confirmed are sent again, unless they are older than
+        # resend_age seconds. Stopping with everything settled retires it,
+        # so each journal holds one session. Starting raises JournalLocked
+        # if another process has it open.
+        self.journal_path = None
+        self.resend_age = 10 * 60
+        # Metrics are appended to metrics_path as JSON lines every
+        # metrics_interval seconds, and served for Prometheus on localhost
+        # at metrics_port.
+        self.metrics_path = None
+        self.metrics_interval = 10
+        self.metrics_port = None
+
+    @property
+    def url(self):
+        """The primary URL."""
+        return self.destinations[0].url
+
+    @url.setter
+    def url(self, url):
+        self.urls = [url] + self.urls[1:]
+
+    @property
+    def urls(self):
+        return [destination.url for destination in self.destinations]
+
+    @urls.setter
+    def urls(self, urls):
+        """
+        Sets the URLs to send to, primary first. Destinations are matched by
+        position, so changing one URL leaves the others' state alone. New
+        destinations get entries sent from then on.
+        """
+        urls = list(urls) or ['']
+        with self.lock:
+            for destination in self.destinations[len(urls):]:
+                destination.stop()
+                self.metrics.remove(destination=destination.name)
+            del self.destinations[len(urls):]
+            for destination, url in zip(self.destinations, urls):
+                if destination.url != url:
+                    destination.url = url
+            for url in urls[len(self.destinations):]:
+                destination = Destination(self, url, name='backup{n}'.format(n=len(self.destinations)))
+                self.destinations.append(destination)
+                if self._running:
+                    destination.start(self._scheduler)
+
+    @property
+    def rtt(self):
+        """Moving average of the primary's post round-trip times, in seconds."""
+        return self.destinations[0].rtt
+
+    @property
+    def clock(self):
+        """The primary's estimate of the server clock."""
+        return self.destinations[0].clock
+
+    def start(self):
+        """Starts sending in the background."""
+        if self.journal_path:
+            # Opened here, so a journal in use elsewhere fails start() at
+            # once; it is read back on the scheduler thread.
+            self._journal = Journal(self.journal_path, history=self.history_size)
+            self._scheduler.call_soon(self._resume)
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+        if self.metrics_path:
+            self._metrics_file = open(self.metrics_path, 'a')
+            self._metrics_timer = self._scheduler.call_later(self.metrics_interval, self._write_metrics)
+        with self.lock:
+            self._running = True
+            for destination in self.destinations:
+                destination.start(self._scheduler)
+
+    def stop(self):
+        """Stops sending in the background."""
+        if self._running:
+            with self.lock:
+                self._running = False
+                for destination in self.destinations:
+                    destination.stop()
+            if self._metrics_timer:
+                self._metrics_timer.cancel()
+            if self._metrics_file:
+                self.metrics.write(self._metrics_file)
+                self._metrics_file.close()
+                self._metrics_file = None
+            self.metrics.close()
+            if self._journal:
+                self._journal.close(retire=True)
+                self._journal = None
+
+    def send(self, items):
+        """Queues items for sending. Safe to call from any thread."""
+        self._scheduler.call_soon(self._add, list(items))
+
+    def entries(self):
+        """
+        Returns an iterator over the entries still held in memory, oldest
+        first. Hold lock while iterating.
+        """
+        return itertools.chain(self._confirmed, self._sent, self.destinations[0]._pending)
+
+    def text(self, start, end):
+        """
+        Returns the text between two positions in spans. It is found by
+        walking back from the newest entry, so text near the end is cheap.
+        Text that has been dropped comes back as spaces. Hold lock.
+        """
+        parts = []
+        pos = self.spans.end
+        for item in itertools.chain(reversed(self.destinations[0]._pending), reversed(self._sent), reversed(self._confirmed)):
+            if pos <= start:
+                break
+            itemstart = pos - len(item.text)
+            if itemstart < end:
+                parts.append(item.text[max(start - itemstart, 0):end - itemstart])
+            pos = itemstart
+        if pos > start:
+            parts.append(' ' * (min(pos, end) - start))
+        return ''.join(reversed(parts))
+
+    def archived_pages(self):
+        return self._archive.pages() if self._archive else 0
+
+    def archived(self, page):
+        """
+        Returns the entries on the given page of the archive, oldest first.
+        Raises IndexError for a page past archived_pages(), as there are
+        none before anything is archived.
+        """
+        if self._archive is None:
+            raise IndexError("no archived page {page}: nothing has been archived".format(page=page))
+        return self._archive.page(page)
+
+    def _resume(self):
+        """Reads the journal back and sends again what wasn't confirmed."""
+        journal = self._journal
+        if journal is None:
+            return # stopped first
+        confirmed = collections.deque(maxlen=self.history_size)
+        unconfirmed = collections.deque()
+        for record in journal.replay():
+            if record[0] == 'e':
+                item = TextEntry(record[2])
+                item.time = monotonic(datetime.datetime.fromisoformat(record[1]))
+                unconfirmed.append(item)
+            else:
+                for _ in range(record[1]):
+                    item = unconfirmed.popleft()
+                    item.status = record[2]
+                    confirmed.append(item)
+        cutoff = self._clock.monotonic_ns() - int(self.resend_age * 1e9)
+        stale = []
+        while unconfirmed and unconfirmed[0].time < cutoff:
+            item = unconfirmed.popleft()
+            item.status = TextEntry.FAILED
+            stale.append(item)
+        if stale:
+            journal.status(len(stale), TextEntry.FAILED)
+        with self.lock:
+            for item in itertools.chain(confirmed, stale):
+                self.spans.append(len(item.text), item.status)
+            self._unsent = self.spans.end
+            changes = list(self.spans)
+            changes += self._history(confirmed)
+            changes += self._history(stale)
+        if changes:
+            self.change_callback(changes)
+        if unconfirmed:
+            self._add(list(unconfirmed), False)
+
+    def _confirm(self, items, status):
+        """Moves items, the oldest sent, into the history. Returns the changes to spans."""
+        for _ in items:
+            self._sent.popleft()
+        if self._journal:
+            self._journal.status(len(items), status)
+        return self._history(items)
+
+    def _history(self, items):
+        """Adds items to the history, archiving the oldest if it is too big. Returns the changes to spans."""
+        self._confirmed.extend(items)
+        count = len(self._confirmed) - self.history_size
+        if count < self.history_batch:
+            count = 0
+        if self.history_age is not None and self._confirmed:
+            cutoff = self._clock.monotonic_ns() - int(self.history_age * 1e9)
+            if self._confirmed[0].time < cutoff - int(self.history_age * 1e8):
+                count = max(count, next((i for i, item in enumerate(self._confirmed) if item.time >= cutoff), len(self._confirmed)))
+        if count:
+            if self.archive:
+                if self._archive is None:
+                    self._archive = Archive(self.archive_path)
+                self._archive.append(itertools.islice(self._confirmed, count))
+            start = self.spans.start
+            end = start
+            for _ in range(count):
+                end += len(self._confirmed.popleft().text)
+            self.spans.drop(end)
+            return [(start, end, None)]
+        return []
+
+    def _write_metrics(self):
+        self.metrics.write(self._metrics_file)
+        self._metrics_timer = self._scheduler.call_later(self.metrics_interval, self._write_metrics)
+
+    def _add(self, items, journal=True):
+        if journal:
+            ns = self._clock.monotonic_ns()
+            for item in items:
+                self._release_latency.observe((ns - item.time) / 1e9)
+            if self._journal:
+                self._journal.entries(items)
+        with self.lock:
+            destinations = list(self.destinations)
+            for destination in destinations:
+                destination._pending.extend(items)
+                excess = len(destination._pending) - self.backup_pending
+                if not destination.primary and excess > 0:
+                    for _ in range(excess):
+                        destination._pending.popleft()
+                    destination._dropped.inc(excess)
+            start = self.spans.end
+            self.spans.append(sum(len(item.text) for item in items), TextEntry.PENDING)
+            end = self.spans.end
+        if end > start:
+            self.change_callback([(start, end, TextEntry.PENDING)])
+        for destination in destinations:
+            destination._update()
+
+class PloverLog:
+    """
+    Follows Plover's log file from a byte offset, reading only what has been
+    appended. When the file is rotated, the rest of the old file is read
+    before switching to the new one; when it is truncated, reading starts
+    again from the top.
+    """
+    def __init__(self, path, offset=0, inode=None):
+        self.path = path
+        self._file = None
+        self._inode = inode
+        self._offset = offset
+        self._partial = b''
+
+    def state(self):
+        """Returns what to pass to the constructor to resume after the last line read."""
+        return {'offset': self._offset - len(self._partial), 'inode': self._inode}
+
+    def _open(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        inode = os.fstat(f.fileno()).st_ino
+        if inode != self._inode:
+            # A different file than the saved offset refers to.
+            self._inode = inode
+            self._offset = 0
+            self._partial = b''
+        f.seek(self._offset)
+        self._file = f
+        return True
+
+    def lines(self):
+        """Returns the complete lines appended since the last call."""
+        if self._file is None and not self._open():
+            return []
+        appended = self._file.read()
+        self._offset += len(appended)
+        data = self._partial + appended
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and stat.st_ino != self._inode:
+            # Rotated: the old file is finished, so carry on with the new one.
+            self._file.close()
+            self._file = None
+            if data and not data.endswith(b'\n'):
+                data += b'\n'
+            if self._open():
+                appended = self._file.read()
+                self._offset = len(appended)
+                data += appended
+        elif stat is not None and stat.st_size < self._offset:
+            # Truncated in place.
+            self._file.seek(0)
+            data = self._file.read()
+            self._offset = len(data)
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        return data[:end].decode('UTF-8', 'replace').splitlines()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+class PloverFormatter:
+    """
+    Turns the translations Plover logs into text, with a space before each
+    word. Covers the common formatting commands: attaching, capitalization,
+    punctuation and fingerspelling. Other commands are dropped.
+    """
+    _line = re.compile(r'(\*?)Translation\(\((.*?)\) : (.*)\)\s*$')
+    _command = re.compile(r'\{([^{}]*)\}|[^{}]+')
+    _stops = frozenset('.?!')
+
+    def __init__(self):
+        self._attach = True
+        self._capitalize = True
+        self._lower = False
+        self._letters = False
+        self._done = collections.deque(maxlen=100) # (text, state before) of recent translations
+
+    def feed(self, line):
+        """
+        Returns (removed, text) for one log line: how many characters to take
+        off the end of the text so far, and what to add. Returns ``None`` for
+        lines that aren't translations.
+        """
+        match = self._line.search(line)
+        if not match:
+            return None
+        undo, strokes, english = match.groups()
+        if undo:
+            if not self._done:
+                return 0, ''
+            text, state = self._done.pop()
+            self._attach, self._capitalize, self._lower, self._letters = state
+            return len(text), ''
+        if english == 'None':
+            english = '/'.join(re.findall(r"'([^']*)'", strokes))
+        state = (self._attach, self._capitalize, self._lower, self._letters)
+        text = self._format(english)
+        self._done.append((text, state))
+        return 0, text
+
+    def _word(self, word, attach):
+        if self._capitalize:
+            word = word[:1].upper() + word[1:]
+        elif self._lower:
+            word = word[:1].lower() + word[1:]
+        self._capitalize = self._lower = False
+        return word if attach else ' ' + word
+
+    def _format(self, english):
+        pieces = []
+        for match in self._command.finditer(english):
+            command = match.group(1)
+            if command is None:
+                if match.group(0).strip():
+                    pieces.append(self._word(match.group(0).strip(), self._attach))
+                    self._attach = self._letters = False
+            elif command.startswith('&'):
+                # Fingerspelled letters run together.
+                pieces.append(self._word(command[1:], self._attach or self._letters))
+                self._attach = False
+                self._letters = True
+            elif command in ('.', '?', '!', ',', ':', ';'):
+                pieces.append(command)
+                self._attach = self._letters = False
+                self._capitalize = command in self._stops
+            elif command == '-|':
+                self._capitalize = True
+            elif command == '>':
+                self._lower = True
+            elif command.startswith('^') or command.endswith('^'):
+                word = command.strip('^')
+                if word:
+                    pieces.append(self._word(word, self._attach or command.startswith('^')))
+                self._attach = command.endswith('^') or not word
+                self._letters = False
+        return ''.join(pieces)
+
+class Streamer:
+    """
+    Feeds text from outside the GUI, such as Plover's log or a pipe, through
+    a release policy into a Client. Text waits in a PendingText until the
+    policy releases it, so undos can still take it back. Runs on the client's
+    scheduler.
+
+    A mark, such as a position in the input, can be placed after the text
+    read so far. Once all that text has been released or taken back, the
+    mark becomes marked, so the input can be picked up from there.
+    """
+    def __init__(self, client, scheduler, policy=None):
+        self.client = client
+        self._scheduler = scheduler
+        self._policy = policy or AdaptivePolicy()
+        self._pending = PendingText()
+        self._timer = None
+        self._released = 0 # characters released so far
+        # [end, value] for each mark not yet passed: end is where the text
+        # from before the mark that is still there ends.
+        self._marks = collections.deque()
+        # The value of the latest mark passed, or None.
+        self.marked = None
+
+    def edit(self, removed, text):
+        """Takes removed characters off the end of the text and adds text. Safe to call from any thread."""
+        self._scheduler.call_soon(self._edit, removed, text)
+
+    def mark(self, value):
+        """Places a mark after the text edited so far. Safe to call from any thread."""
+        self._scheduler.call_soon(self._mark, value)
+
+    def flush(self):
+        """
+        Sends everything pending. Safe to call from any thread. Returns an
+        event that is set once the client has the text.
+        """
+        done = threading.Event()
+        self._scheduler.call_soon(self._flush, done)
+        return done
+
+    def _edit(self, removed, text):
+        now = self._scheduler.clock.monotonic_ns()
+        self._policy.keystroke(now)
+        # Text that has already been released can't be taken back.
+        length = self._pending.length()
+        removed = min(removed, length)
+        self._pending.edit(length - removed, removed, text, now, self._policy)
+        # Text taken back no longer has to be released for a mark to pass.
+        end = self._released + length - removed
+        for mark in reversed(self._marks):
+            if mark[0] <= end:
+                break
+            mark[0] = end
+        self._passed()
+        self._release()
+
+    def _mark(self, value):
+        self._marks.append([self._released + self._pending.length(), value])
+        self._passed()
+
+    def _send(self, items):
+        self.client.send(items)
+        self._released += sum(len(item.text) for item in items)
+        self._passed()
+
+    def _passed(self):
+        while self._marks and self._marks[0][0] <= self._released:
+            self.marked = self._marks.popleft()[1]
+
+    def _flush(self, done):
+        self._send(self._pending.release(len(self._pending)))
+        # Client.send queues on this thread too, so this runs after it.
+        self._scheduler.call_soon(done.set)
+
+    def _release(self):
+        now = self._scheduler.clock.monotonic_ns()
+        items = self._pending.release(self._policy.release(self._pending, now, self.client.rtt))
+        if items:
+            self._policy.released(now)
+            self._send(items)
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        deadline = self._policy.deadline(self._pending, now, self.client.rtt)
+        if deadline is not None:
+            self._timer = self._scheduler.call_later(max(deadline - now, 0) / 1e9, self._release)
+
+class Uploader:
+    """
+    Sends a recorded transcript, such as one read by transcript(), as fast
+    as the primary destination acknowledges it. Only limit entries are held
+    at a time, so memory stays the same whatever the length of the
+    transcript, and the client's window keeps several posts in flight.
+    Backups are sent what they keep up with, and never slow the upload.
+    Client settings are changed for the upload: nothing is kept once
+    acknowledged.
+
+    A batch is retried for a couple of minutes rather than the few seconds
+    a live session allows. If one is given up on all the same, the upload stops
+    after what is in flight, and run() reports the failed entries.
+
+    With state_path, progress is saved there, and an upload of the same
+    file from the same start time started again skips the entries
+    acknowledged before the first that wasn't. Sequence numbers are reserved ahead in the state, so the
+    resumed upload never reuses one the server may have seen. After a
+    crash, up to about a second of captions may be sent twice.
+    """
+    _save_interval = 1
+    _seq_reserve = 1000
+    _retry_timeout = 120
+
+    def __init__(self, client, scheduler, entries, state_path=None, limit=None):
+        self.client = client
+        self._scheduler = scheduler
+        self._entries = iter(entries)
+        self._begun = False
+        self._state_path = state_path
+        self._limit = limit or 2 * client.window * client.batch_entries
+        self._sending = collections.deque()
+        self._done = threading.Event()
+        self._error = None
+        self._source = None
+        self._start_time = None
+        self._saved = 0
+        self._saved_at = 0
+        self._seq = 0
+        self._start = None
+        # Progress, in entries of the transcript: those acknowledged from
+        # the start, and those given up on.
+        self.acknowledged = 0
+        self.failed = 0
+        self.characters = 0
+        client.retry_timeout = self._retry_timeout
+        client.history_size = 0
+        client.history_age = None
+        client.archive = False
+        client.change_callback = lambda changes: self._fill()
+        client.post_callback = lambda destination, success: self._fill()
+
+    @staticmethod
+    def saved(state_path, source):
+        """Returns the progress saved at state_path of uploading source, or an empty dict."""
+        if not os.path.exists(state_path):
+            return {}
+        with open(state_path) as f:
+            state = json.load(f)
+        return state if state.get('source') == source else {}
+
+    def run(self, source=None, report_interval=5, start=None):
+        """
+        Sends everything, printing progress every report_interval seconds,
+        and returns a report as a dict. The client must be started. Source
+        names the transcript in the saved state, along with start, the UTC
+        datetime its times were taken from, if any. An error reading the
+        entries stops the upload and is raised here.
+        """
+        self._source = source
+        self._start_time = start.isoformat() if start else None
+        state = self.saved(self._state_path, source) if self._state_path else {}
+        # Sequence numbers stay reserved whatever was uploaded before.
+        self._seq = state.get('seq', 0)
+        if state.get('start') != self._start_time:
+            state = {}
+        skipped = state.get('entries', 0)
+        self._start = self._scheduler.clock.monotonic()
+        self._scheduler.call_soon(self._begin, skipped)
+        while not self._done.wait(report_interval):
+            print(self._progress(), file=sys.stderr)
+        if self._error is not None:
+            raise self._error
+        elapsed = self._scheduler.clock.monotonic() - self._start
+        primary = self.client.destinations[0]
+        return {
+            'seconds': elapsed,
+            'skipped_entries': skipped,
+            'entries': self.acknowledged - skipped,
+            'failed_entries': self.failed,
+            'characters': self.characters,
+            'entries_per_second': (self.acknowledged - skipped) / elapsed if elapsed else 0,
+            'characters_per_second': self.characters / elapsed if elapsed else 0,
+            'posts': primary._successes.snapshot() + primary._failures.snapshot(),
+            'retries': primary._retries.snapshot(),
+        }
+
+    def _progress(self):
+        elapsed = self._scheduler.clock.monotonic() - self._start
+        return "{entries} entries acknowledged, {failed} failed, {rate:.0f} characters/s".format(
+            entries=self.acknowledged, failed=self.failed, rate=self.characters / elapsed if elapsed else 0)
+
+    def _begin(self, skipped):
+        try:
+            for _ in itertools.islice(self._entries, skipped):
+                pass
+            self.acknowledged = self._saved = skipped
+            self._begun = True
+            with self.client.lock:
+                for destination in self.client.destinations:
+                    destination._seq = max(destination._seq, self._seq)
+            self._reserve()
+        except Exception as error:
+            self._fail(error)
+            return
+        self._fill()
+
+    def _fail(self, error):
+        """Stops the upload, for run() to raise error."""
+        self._error = error
+        self._entries = None
+        self._done.set()
+
+    def _fill(self):
+        """Counts what has settled and sends more. Runs on the scheduler thread."""
+        if not self._begun or self._done.is_set():
+            return
+        try:
+            self._settle_and_send()
+        except Exception as error:
+            self._fail(error)
+
+    def _settle_and_send(self):
+        client = self.client
+        with client.lock:
+            while self._sending and self._sending[0].status in (TextEntry.SUCCESS, TextEntry.FAILED):
+                item = self._sending.popleft()
+                if item.status == TextEntry.FAILED:
+                    # Nothing more is sent, and progress stays before it.
+                    self.failed += 1
+                    self._entries = None
+                elif not self.failed:
+                    self.acknowledged += 1
+                    self.characters += len(item.text)
+            # Backups drop what they can't keep up with, so only the
+            # primary's queue holds the upload back.
+            backlog = len(client.destinations[0]._pending)
+        self._reserve()
+        items = []
+        if self._entries is not None:
+            room = min(self._limit - len(self._sending), self._limit - backlog)
+            items = list(itertools.islice(self._entries, max(room, 0)))
+            if len(items) < room:
+                self._entries = None
+        if items:
+            self._sending.extend(items)
+            client.send(items)
+        if self._state_path and self.acknowledged > self._saved and (
+                not self._sending or self._scheduler.clock.monotonic() >= self._saved_at + self._save_interval):
+            self._save()
+        if self._entries is None and not self._sending:
+            self._done.set()
+
+    def _reserve(self):
+        """Saves sequence numbers further ahead once the destinations near the last reserved."""
+        with self.client.lock:
+            seq = max(destination._seq for destination in self.client.destinations)
+        if seq > self._seq - self._seq_reserve // 2:
+            self._seq = seq + self._seq_reserve
+            if self._state_path:
+                self._save()
+
+    def _save(self):
+        with open(self._state_path + '.tmp', 'w') as f:
+            json.dump({'source': self._source, 'start': self._start_time, 'entries': self.acknowledged, 'seq': self._seq}, f)
+        os.replace(self._state_path + '.tmp', self._state_path)
+        self._saved = self.acknowledged
+        self._saved_at = self._scheduler.clock.monotonic()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sends captions from Plover's log, or from standard input, without the GUI.")
+    parser.add_argument('urls', metavar='url', nargs='*', help="caption ingestion URL from YouTube; give more for a backup or a mirror")
+    parser.add_argument('--plover-log', metavar='PATH', help="Plover log file to follow; logging translations must be enabled in Plover")
+    parser.add_argument('--state', metavar='PATH', help="file to keep the log position or upload progress in, so a restart carries on where it stopped")
+    parser.add_argument('--poll', type=float, default=0.1, help="seconds between checks of the log")
+    parser.add_argument('--delay', type=float, default=5, help="longest time text is held for corrections, in seconds")
+    parser.add_argument('--journal', metavar='PATH', help="file to record everything sent in; if it exists, sending resumes from it")
+    parser.add_argument('--metrics-file', metavar='PATH', help="file to append metrics to as JSON lines")
+    parser.add_argument('--metrics-port', type=int, help="local port to serve metrics on for Prometheus")
+    parser.add_argument('--export', choices=['srt', 'vtt'], help="write the journal out as subtitles on standard output instead of sending")
+    parser.add_argument('--upload', metavar='PATH', help="send a recorded SRT, WebVTT or journal file as fast as the server takes it, then exit")
+    parser.add_argument('--upload-format', choices=['srt', 'vtt', 'journal'], help="format of the --upload file, if its name doesn't say")
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, metavar='TIME',
+        help="UTC time the uploaded captions start at, such as 2024-05-01T18:00:00; subtitles default to now, or to the start of the upload being resumed, journals to their own times")
+    parser.add_argument('--window', type=int, help="posts in flight at once per URL (default 4, or 8 for --upload)")
+    parser.add_argument('--batch-bytes', type=int, help="largest post body the server accepts (default 8192)")
+    args = parser.parse_args(argv)
+    if args.export:
+        if not args.journal:
+            parser.error("--export needs --journal")
+        export(args.journal, sys.stdout, args.export)
+        return
+    if not args.urls:
+        parser.error("a URL is needed")
+
+    scheduler = Scheduler.shared()
+    client = Client(scheduler)
+    client.urls = args.urls
+    client.metrics_path = args.metrics_file
+    client.metrics_port = args.metrics_port
+    client.window = args.window or (8 if args.upload else client.window)
+    client.batch_bytes = args.batch_bytes or client.batch_bytes
+    if args.upload:
+        # Found out now, rather than once the upload has started.
+        try:
+            open(args.upload, 'rb').close()
+        except OSError as error:
+            parser.error("can't read {path}: {error}".format(path=args.upload, error=error.strerror))
+        source = os.path.abspath(args.upload)
+        start = args.start
+        if start is None and (args.upload_format or _transcript_format(args.upload)) != 'journal':
+            # Subtitles carrying on an upload keep the start it had, so the
+            # cues sent before and after the break line up.
+            saved = Uploader.saved(args.state, source).get('start') if args.state else None
+            start = datetime.datetime.fromisoformat(saved) if saved else datetime.datetime.utcnow()
+        uploader = Uploader(client, scheduler, transcript(args.upload, args.upload_format, start), args.state)
+        client.start()
+        try:
+            report = uploader.run(source, start=start)
+        except KeyboardInterrupt:
+            return
+        except (OSError, ValueError) as error:
+            sys.exit("can't upload {path}: {error}".format(path=args.upload, error=error))
+        finally:
+            client.stop()
+        print("{entries} entries, {characters} characters in {seconds:.1f} s: {entries_per_second:.0f} entries/s, "
+            "{characters_per_second:.0f} characters/s, {posts} posts, {retries} retries, {failed_entries} entries failed".format(**report))
+        if report['skipped_entries']:
+            print("{skipped_entries} entries were already sent".format(**report))
+        if report['failed_entries']:
+            sys.exit("stopped where the server didn't take a batch" + ("; run again to carry on from there" if args.state else ""))
+        return
+    client.journal_path = args.journal
+    try:
+        client.start()
+    except JournalLocked:
+        parser.error("{path} is in use by another process".format(path=args.journal))
+    streamer = Streamer(client, scheduler, AdaptivePolicy(delay=args.delay))
+    state = {}
+
+    def save():
+        """Saves the log position after the text released so far."""
+        nonlocal state
+        if args.state and streamer.marked is not None and streamer.marked != state:
+            state = streamer.marked
+            with open(args.state + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(args.state + '.tmp', args.state)
+
+    try:
+        if args.plover_log:
+            if args.state and os.path.exists(args.state):
+                with open(args.state) as f:
+                    state = json.load(f)
+            log = PloverLog(args.plover_log, **state)
+            formatter = PloverFormatter()
+            while True:
+                lines = log.lines()
+                for line in lines:
+                    edit = formatter.feed(line)
+                    if edit:
+                        streamer.edit(*edit)
+                if lines:
+                    # Text still held for corrections would be lost if the
+                    # log were picked up after it, so the position is only
+                    # saved once the text before it has been released.
+                    streamer.mark(log.state())
+                save()
+                time.sleep(args.poll)
+        else:
+            for line in sys.stdin:
+                streamer.edit(0, line)
+            streamer.flush().wait()
+            # Wait for the last posts to finish.
+            while True:
+                time.sleep(args.poll)
+                with client.lock:
+                    if all(item.status in (TextEntry.SUCCESS, TextEntry.FAILED) for item in client.entries()):
+                        break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # What is still held goes out, or into the journal, before stopping.
+        streamer.flush().wait()
+        save()
+        client.stop()
+
+if __name__ == "__main__":
+    main()
@@ -1,123 +1,235 @@
+import bisect
 import collections
 import datetime
-import http.client
-import io
 import itertools
-import os.path
-import queue
+import os
 import random
-import requests
+import re
 import threading
 import time
 import wx
 import wx.lib.scrolledpanel
-import wx.lib.wordwrap
 
-# TODO: Drop old text for long documents or maybe make the colored text more efficient so the whole thing isn't re-rendered all the time.
-# TODO: option to pull data from plover's log?
-# TODO: save text to file?
-
-class TextEntry:
-    PENDING = 0
-    SENT = 1
-    SUCCESS = 2
-    FAILED = 3
-    
-    def __init__(self, text=''):
-        self.time = datetime.datetime.utcnow()
-        self.text = text
-        self.status = TextEntry.PENDING
-        
-    def __repr__(self):
-        return "TextEntry({time}, {text}, {status})".format(time=self.time,text=self.text,status=self.status)
-
-class Client:
-    def __init__(self):
-        # constants
-        self._heartbeat_interval = datetime.timedelta(seconds=5)
-        self._retry_timeout = datetime.timedelta(seconds=5)
-        self._poll_interval = 1
-        self._post_timeout = 0.2
-        
-        # state
-        self._confirmed = collections.deque()
-        self._sent = collections.deque()
-        self._pending = collections.deque()
-        self._seq = 0
-        self._retry_start = datetime.datetime.utcnow()
-        self._retry_delay = 0
-        self._last_post = datetime.datetime.utcnow() - self._heartbeat_interval
-        self._correction = datetime.timedelta()
-
-        # settings
-        self.post_callback = lambda x: None
-        self.url = ''
-        self.offset = datetime.timedelta()
-        
-    def send(self, items):
-        self._pending.extend(items)
-
-    def entries(self):
-        r = list(self._confirmed)
-        r.extend(self._sent)
-        r.extend(self._pending)
-        return r
-
-    def _retry(self):
-        if self._post(self._seq, self._sent):
-            for item in self._sent:
-                item.status = TextEntry.SUCCESS
-            self._confirmed.extend(self._sent)
-            self._sent.clear()
-            return 0 if self._pending else self._poll_interval
+from captions import AdaptivePolicy, Client, JournalLocked, PendingText, Streamer, TextEntry
+
+def _common_prefix_length(a, b):
+    """Returns the length of the longest common prefix of two strings."""
+    # Compare in chunks so the scan runs in C, then bisect the first
+    # chunk that differs.
+    n = min(len(a), len(b))
+    chunk = 4096
+    lo = 0
+    while lo < n and a[lo:lo + chunk] == b[lo:lo + chunk]:
+        lo += chunk
+    hi = min(lo + chunk, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
         else:
-            if datetime.datetime.utcnow() - self._retry_start >= self._retry_timeout:
-                for item in self._sent:
-                    item.status = TextEntry.FAILED
-                self._confirmed.extend(self._sent)
-                self._sent.clear()
-                return 0 if self._pending else self._poll_interval
-            self._retry_delay *= 2
-            return random.uniform(0, self._retry_delay)
-
-    def tick(self):
-        """Runs background activities. Returns the delay, in seconds, until the next call to tick."""
-        now = datetime.datetime.utcnow()
-        if self._sent:
-            return self._retry()
-        
-        self._sent.extend(self._pending)
-        self._pending.clear()
-        if self._sent:
-            self._seq += 1
-            self._retry_start = datetime.datetime.utcnow()
-            self._retry_delay = 0.1
-            for item in self._sent:
-                item.status = TextEntry.SENT
-            return self._retry()
-        if now - self._last_post >= self._heartbeat_interval:
-            self._seq += 1
-            self._post(self._seq, [TextEntry()])
-        return self._poll_interval
-
-    def _post(self, seq, items):
-        headers = {'content-type': 'text/plain'}
-        buf = io.StringIO(newline="\n")
-        offset = self.offset
-        for item in items:
-            print((item.time + offset + self._correction).isoformat()[:-3], item.text.replace("\n", "<br>"), sep="\n", end="\n", file=buf, flush=True)
-        data = buf.getvalue()
-        try:
-            r = requests.post(self.url + "&seq={seq}".format(seq=seq), data=data, headers=headers, timeout=self._post_timeout)
-            r.raise_for_status()
-            self._correction = datetime.datetime.strptime(r.text.strip(), "%Y-%m-%dT%H:%M:%S.%f") - datetime.datetime.utcnow()
-            success = True
-        except requests.exceptions.RequestException:
-            success = False
-        self._last_post = datetime.datetime.utcnow()
-        self.post_callback(success)
-        return success
-        
+            hi = mid - 1
+    return lo
+
+class WordWrapper:
+    """
+    Greedy word wrapper that breaks after spaces, like wx.lib.wordwrap. The
+    width of every word is remembered per font so that wrapping again after
+    an edit or a resize only measures words it has not seen.
+    """
+    _tokens = re.compile(r'\n| +|[^ \n]+')
+    _max_cached_words = 100000
+
+    def __init__(self, measure):
+        self._measure = measure
+        self._caches = {}
+        self._widths = self._caches.setdefault(None, {})
+
+    def set_font(self, key):
+        """Selects the word width cache for the font identified by key."""
+        self._widths = self._caches.setdefault(key, {})
+
+    def _width(self, word):
+        width = self._widths.get(word)
+        if width is None:
+            if len(self._widths) >= self._max_cached_words:
+                self._widths.clear()
+            width = self._widths[word] = self._measure(word)
+        return width
+
+    def _fit(self, word, width):
+        """Returns how many characters of word fit in width, at least one."""
+        lo, hi = 1, len(word)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._measure(word[:mid]) <= width:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def lines(self, text, start, width=None):
+        """
+        Yields (start, end, width) for each line of text from start, which
+        must be the start of a line, to the end. Lines end at newlines, which
+        are not included, or where the next word doesn't fit in width.
+        """
+        linestart = start
+        x = 0
+        for match in self._tokens.finditer(text, start):
+            token = match.group()
+            if token == '\n':
+                yield linestart, match.start(), x
+                linestart = match.end()
+                x = 0
+                continue
+            w = self._width(token)
+            if width is None or token[0] == ' ' or x + w <= width:
+                x += w
+                continue
+            if x:
+                yield linestart, match.start(), x
+                linestart = match.start()
+                x = 0
+            while w > width and len(token) > 1:
+                n = self._fit(token, width)
+                yield linestart, linestart + n, self._measure(token[:n])
+                linestart += n
+                token = token[n:]
+                w = self._measure(token)
+            x = w
+        yield linestart, len(text), x
+
+class Layout:
+    """
+    The wrapped lines of a text at one width and font, with the colored
+    runs the text had when the layout was asked for. A Layout is never
+    changed once made, so the layout thread can build the next one while
+    the UI thread paints this one.
+    """
+    __slots__ = ('text', 'runstarts', 'styles', 'width', 'font', 'serial', 'changed', 'seconds',
+                 'linestarts', 'lineends', 'lineys', 'lineheights', 'linewidths', 'maxwidths')
+
+    def size(self):
+        return self.maxwidths[-1], self.lineys[-1] + self.lineheights[-1]
+
+    def line(self, offset):
+        """Returns the index of the line holding the character at offset."""
+        return max(bisect.bisect_right(self.linestarts, offset) - 1, 0)
+
+class LayoutWorker:
+    """
+    Wraps text on a thread of its own and passes each finished Layout to
+    deliver, on that thread. Requests made while it is busy are merged, so
+    a burst of resizes only lays out the last width.
+
+    wx can only measure text on the UI thread, so requests carry a table of
+    character widths, filled in by the caller, and words are measured as
+    the sum of their characters.
+    """
+    def __init__(self, deliver):
+        self._deliver = deliver
+        self._condition = threading.Condition()
+        self._request = None
+        self._dirty = None
+        self._busy = False
+        self._stopped = False
+        self._thread = None
+        self._layout = None # the last one made
+        self._serial = 0
+        self._chars = {}
+        self._unknown = 0 # width of characters missing from _chars
+        self._wrapper = WordWrapper(self._measure)
+
+    def request(self, text, runs, dirty, width, font, chars, emptywidth, lineheight):
+        """
+        Asks for text to be wrapped to width, reusing the lines of the
+        previous layout before the offset dirty. runs, the run starts and
+        styles of text, is kept on the layout. chars maps every character
+        in text from dirty on to its width in font.
+        """
+        with self._condition:
+            self._request = (text, runs, width, font, chars, emptywidth, lineheight)
+            self._dirty = dirty if self._dirty is None else min(self._dirty, dirty)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name="Layout", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def wait(self):
+        """Waits for the requests made so far and returns the last layout."""
+        with self._condition:
+            while self._request or self._busy:
+                self._condition.wait()
+            return self._layout
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _measure(self, word):
+        chars, unknown = self._chars, self._unknown
+        return sum(chars.get(c, unknown) for c in word)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._request and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                request, dirty = self._request, self._dirty
+                self._request = self._dirty = None
+                self._busy = True
+            try:
+                layout = self._wrap(dirty, *request)
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+            self._deliver(layout)
+
+    def _wrap(self, dirty, text, runs, width, font, chars, emptywidth, lineheight):
+        started = time.perf_counter()
+        previous = self._layout
+        if previous is None or previous.width != width or previous.font != font:
+            dirty = 0
+        layout = Layout()
+        # An edit can pull the first word of its line back onto the previous
+        # line, so wrapping restarts one line before the changed one.
+        first = max(previous.line(dirty) - 1, 0) if dirty else 0
+        for name in ('linestarts', 'lineends', 'lineys', 'lineheights', 'linewidths', 'maxwidths'):
+            setattr(layout, name, getattr(previous, name)[:first] if first else [])
+        pos = previous.linestarts[first] if first else 0
+        y = previous.lineys[first] if first else 0
+        maxwidth = previous.maxwidths[first - 1] if first else 0
+
+        self._chars = chars
+        self._unknown = emptywidth
+        self._wrapper.set_font(font)
+        for start, end, w in self._wrapper.lines(text, pos, width):
+            if start == end:
+                w = emptywidth
+            maxwidth = max(maxwidth, w)
+            layout.linestarts.append(start)
+            layout.lineends.append(end)
+            layout.lineys.append(y)
+            layout.lineheights.append(lineheight)
+            layout.linewidths.append(w)
+            layout.maxwidths.append(maxwidth)
+            y += lineheight
+        self._serial += 1
+        layout.text = text
+        layout.runstarts, layout.styles = runs
+        layout.width = width
+        layout.font = font
+        layout.serial = self._serial
+        layout.changed = pos
+        layout.seconds = time.perf_counter() - started
+        with self._condition:
+            self._layout = layout
+        return layout
+
 class ColoredText:
     def __init__(self, text, color, bgcolor):
         self.text = text
@@ -156,27 +268,208 @@ class ColoredStaticText(wx.Control):
         wx.Control.__init__(self, parent, ID, pos, size, style|wx.NO_BORDER,
                              wx.DefaultValidator, name)
 
-        self.label = [ColoredText(label, "black", "white")]
+        # The label is kept as the joined text plus the start offset and
+        # colors of each run. Line breaks are worked out on a LayoutWorker
+        # thread, from the first offset that changed, and painted from the
+        # last Layout it delivered (self._shown). Until the layout of the
+        # current text arrives, the shown one is painted with the runs it
+        # was made with, and repaints wait for the new one from
+        # self._stale on.
+        self._text = label
+        self._runstarts = [0]
+        self._styles = [("black", "white")]
+        self._stale = None
+        self._wrapwidth = None
+        self._charwidths = {} # font -> character -> width
+        self._worker = LayoutWorker(lambda layout: wx.CallAfter(self._showlayout, layout))
+        self._shown = None
+        # Histograms, such as from captions.Metrics, to record paint and
+        # layout times in.
+        self.paint_histogram = None
+        self.layout_histogram = None
+        # Called after a new layout is shown, for instance to scroll to it.
+        self.layout_callback = None
+
         wx.Control.SetLabel(self, label) # don't check wx.ST_NO_AUTORESIZE yet
         self.InheritAttributes()
+        self._requestlayout(0)
+        self._shown = self._worker.wait()
         self.SetInitialSize(size)
 
         self.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
         self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
         self._bgpen = wx.ThePenList.FindOrCreatePen("white")
         self._bgbrush = wx.TheBrushList.FindOrCreateBrush("white")
 
+    @property
+    def label(self):
+        """The label as a list of :class:`ColoredText` runs, built on each access."""
+        ends = self._runstarts[1:] + [len(self._text)]
+        return [ColoredText(self._text[s:e], c, b) for s, e, (c, b) in zip(self._runstarts, ends, self._styles)]
+
     def SetLabel(self, label):
         """
-        label is a sequence of pairs of color and string.
+        label is a sequence of :class:`ColoredText` runs.
+
+        Only the lines from the first changed character onward are laid out
+        again, and only the lines from the first changed run are repainted.
+        Changed text is repainted once its layout is ready.
         """
-        self.label = label
-        wx.Control.SetLabel(self, ''.join(item.text for item in label))
-        style = self.GetWindowStyleFlag()
+        label = list(label)
+        text = ''.join(item.text for item in label)
+        starts = list(itertools.accumulate((len(item.text) for item in label[:-1]), initial=0)) if label else []
+        styles = [(item.color, item.bgcolor) for item in label]
+        restyled = len(text)
+        for start, style, oldstart, oldstyle in zip(starts, styles, self._runstarts, self._styles):
+            if start != oldstart or style != oldstyle:
+                restyled = min(start, oldstart)
+                break
+        else:
+            if len(starts) != len(self._runstarts):
+                restyled = min(starts[len(self._runstarts):] + self._runstarts[len(starts):])
+        self._runstarts = starts
+        self._styles = styles
+        if text != self._text:
+            changed = _common_prefix_length(self._text, text)
+            self._text = text
+            self._textchanged(changed)
+            self._refreshfrom(restyled, changed)
+        elif restyled < len(text):
+            self._refreshfrom(restyled)
+
+    def AppendLabel(self, label):
+        """
+        Appends a sequence of :class:`ColoredText` runs to the end of the label
+        without laying out the existing text again.
+        """
+        oldlength = len(self._text)
+        length = oldlength
+        pieces = [self._text]
+        for item in label:
+            if not item.text:
+                continue
+            style = (item.color, item.bgcolor)
+            if not length:
+                self._runstarts, self._styles = [], []
+            if not self._styles or self._styles[-1] != style:
+                self._runstarts.append(length)
+                self._styles.append(style)
+            pieces.append(item.text)
+            length += len(item.text)
+        if length != oldlength:
+            self._text = ''.join(pieces)
+            self._textchanged(oldlength)
+
+    def RemoveLabel(self, count):
+        """Removes the first count characters of the label."""
+        count = min(count, len(self._text))
+        if count <= 0:
+            return
+        if count == len(self._text):
+            self._runstarts, self._styles = [0], self._styles[-1:]
+        else:
+            first = bisect.bisect_right(self._runstarts, count) - 1
+            self._runstarts = [0] + [start - count for start in self._runstarts[first + 1:]]
+            del self._styles[:first]
+        self._text = self._text[count:]
+        self._textchanged(0)
+
+    def RestyleLabel(self, start, end, color, bgcolor):
+        """
+        Changes the colors of the characters from start to end without laying
+        out the text again.
+        """
+        start = max(start, 0)
+        end = min(end, len(self._text))
+        if start >= end:
+            return
+        first = self._splitrun(start)
+        last = self._splitrun(end) if end < len(self._text) else len(self._runstarts)
+        self._runstarts[first:last] = [start]
+        self._styles[first:last] = [(color, bgcolor)]
+        # Merge with identically colored neighbours.
+        if first + 1 < len(self._runstarts) and self._styles[first + 1] == (color, bgcolor):
+            del self._runstarts[first + 1]
+            del self._styles[first + 1]
+        if first > 0 and self._styles[first - 1] == (color, bgcolor):
+            del self._runstarts[first]
+            del self._styles[first]
+        self._refreshfrom(start, end)
+
+    def _splitrun(self, offset):
+        """Ensures a run starts at offset and returns its index."""
+        index = bisect.bisect_right(self._runstarts, offset) - 1
+        if self._runstarts[index] == offset:
+            return index
+        self._runstarts.insert(index + 1, offset)
+        self._styles.insert(index + 1, self._styles[index])
+        return index + 1
+
+    def _textchanged(self, offset):
+        wx.Control.SetLabel(self, self._text)
+        if self._stale is not None:
+            # Offsets from here on no longer mean what they did.
+            self._stale = min(self._stale, offset)
+        self._requestlayout(offset)
+
+    def _requestlayout(self, offset, measure=True):
+        """
+        Asks for the lines from offset onward to be laid out again. Unless
+        measure is False, characters from offset on that haven't been seen
+        in this font are measured first, as only this thread can.
+        """
+        font = self.GetFont().GetNativeFontInfoDesc()
+        chars = self._charwidths.setdefault(font, {})
+        if measure:
+            for c in set(self._text[offset:]).difference(chars):
+                chars[c] = self.GetTextExtent(c)[0]
+        emptywidth, lineheight = self.GetTextExtent('W')  # empty lines have height too
+        runs = (list(self._runstarts), list(self._styles))
+        self._worker.request(self._text, runs, offset, self._wrapwidth, font, chars, emptywidth, lineheight)
+
+    def _showlayout(self, layout):
+        """Paints from a layout delivered by the worker, if it is newer than the one shown."""
+        if not self or layout.serial <= self._shown.serial:
+            return
+        # A layout only knows what changed since the one before it.
+        changed = layout.changed if layout.serial == self._shown.serial + 1 else 0
+        self._shown = layout
+        if self._stale is not None and layout.text is self._text:
+            changed = min(changed, self._stale)
+            self._stale = None
+        if self.layout_histogram:
+            self.layout_histogram.observe(layout.seconds)
         self.InvalidateBestSize()
-        if not style & wx.ST_NO_AUTORESIZE:
+        if not self.GetWindowStyleFlag() & wx.ST_NO_AUTORESIZE:
             self.SetSize(self.GetBestSize())
-        self.Refresh()
+        self._refreshfrom(changed)
+        if self.layout_callback:
+            self.layout_callback()
+
+    def FinishLayout(self):
+        """Waits for the layout of the current text and width, and shows it."""
+        self._showlayout(self._worker.wait())
+
+    def _refreshfrom(self, start, end=None):
+        """Repaints the lines holding the characters from start to end."""
+        if end is not None and start >= end:
+            return
+        layout = self._shown
+        if layout.text is not self._text:
+            # Its lines are for other text; the next layout repaints this.
+            self._stale = start if self._stale is None else min(self._stale, start)
+            return
+        width, height = self.GetClientSize()
+        first = layout.line(start)
+        top = layout.lineys[first]
+        if end is None:
+            bottom = height
+        else:
+            last = layout.line(end)
+            bottom = layout.lineys[last] + layout.lineheights[last]
+        if bottom > top:
+            self.RefreshRect(wx.Rect(0, top, width, bottom - top))
 
     def SetFont(self, font):
         """
@@ -188,11 +481,7 @@ class ColoredStaticText(wx.Control):
         """
         
         wx.Control.SetFont(self, font)
-        style = self.GetWindowStyleFlag()
-        self.InvalidateBestSize()
-        if not style & wx.ST_NO_AUTORESIZE:
-            self.SetSize(self.GetBestSize())
-        self.Refresh()
+        self._requestlayout(0)
 
     def DoGetBestSize(self):
         """
@@ -202,22 +491,7 @@ class ColoredStaticText(wx.Control):
         .. note:: Overridden from :class:`Control`.
         """
         
-        label = self.GetLabel()
-        font = self.GetFont()
-        if not font:
-            font = wx.SystemSettings.GetFont(wx.SYS_DEFAULT_GUI_FONT)
-        dc = wx.ClientDC(self)
-        dc.SetFont(font)
-        
-        maxWidth = totalHeight = 0
-        for line in label.split('\n'):
-            if line == '':
-                w, h = dc.GetTextExtent('W')  # empty lines have height too
-            else:
-                w, h = dc.GetTextExtent(line)
-            totalHeight += h
-            maxWidth = max(maxWidth, w)
-        best = wx.Size(maxWidth, totalHeight)
+        best = wx.Size(*self._shown.size())
         self.CacheBestSize(best)
         return best
 
@@ -304,47 +578,58 @@ class ColoredStaticText(wx.Control):
         if not width or not height:
             return
             
+        started = time.perf_counter()
+        layout = self._shown
         dc = wx.AutoBufferedPaintDC(self)
+        left, top, boxwidth, boxheight = self.GetUpdateRegion().GetBox()
         dc.SetPen(self._bgpen)
         dc.SetBrush(self._bgbrush)
-        dc.DrawRectangle(0, 0, width, height)
+        dc.DrawRectangle(left, top, boxwidth, boxheight)
             
         dc.SetFont(self.GetFont())
         dc.SetBackgroundMode(wx.SOLID)
         style = self.GetWindowStyleFlag()
-        x = y = 0
-        lines = []
-        line = []
-        for part in self.label:
-            text = part.text
-            while text:
-                before, sep, text = text.partition('\n')
-                line.append(ColoredText(before, part.color, part.bgcolor))
-                if sep:
-                    lines.append(line)
-                    line = []
-        if line:
-            lines.append(line)
-        y = 0
-        _, emptylineheight = self.GetTextExtent('W')
-        for line in lines:
+        # The text the layout was made for; newer text waits for its layout.
+        # Runs restyled since then are shown once it is the current text.
+        text = layout.text
+        if text is self._text:
+            runstarts, styles = self._runstarts, self._styles
+        else:
+            runstarts, styles = layout.runstarts, layout.styles
+        # Only the lines overlapping the damaged area are drawn.
+        first = max(bisect.bisect_right(layout.lineys, top) - 1, 0)
+        last = bisect.bisect_left(layout.lineys, top + boxheight)
+        for i in range(first, last):
+            start, end = layout.linestarts[i], layout.lineends[i]
+            if start == end:
+                continue
             x = 0
-            text = ''.join(item.text for item in line)
-            if not text:
-                y += emptylineheight
-            else:
-                linewidth, lineheight = self.GetTextExtent(text)
-                if style & wx.ALIGN_RIGHT:
-                    x = width - linewidth
-                elif style & wx.ALIGN_CENTER:
-                    x = (width - linewidth)/2
-                for item in line:
-                    dc.SetTextForeground(item.color)
-                    dc.SetTextBackground(item.bgcolor)
-                    dc.DrawText(item.text, x, y)
-                    w, _ = self.GetTextExtent(item.text)
+            y = layout.lineys[i]
+            if style & wx.ALIGN_RIGHT:
+                x = width - layout.linewidths[i]
+            elif style & wx.ALIGN_CENTER:
+                x = (width - layout.linewidths[i])/2
+            run = bisect.bisect_right(runstarts, start) - 1
+            pos = start
+            while pos < end:
+                runend = runstarts[run + 1] if run + 1 < len(runstarts) else len(text)
+                piece = text[pos:min(runend, end)]
+                if piece:
+                    color, bgcolor = styles[run]
+                    dc.SetTextForeground(color)
+                    dc.SetTextBackground(bgcolor)
+                    dc.DrawText(piece, x, y)
+                    w, _ = dc.GetTextExtent(piece)
                     x += w
-                y += lineheight
+                    pos += len(piece)
+                run += 1
+        if self.paint_histogram:
+            self.paint_histogram.observe(time.perf_counter() - started)
+
+    def OnDestroy(self, event):
+        event.Skip()
+        if event.GetEventObject() is self:
+            self._worker.stop()
 
     def OnEraseBackground(self, event):
         """
@@ -357,34 +642,32 @@ class ColoredStaticText(wx.Control):
 
         pass
         
-    def Wrap(self, width):
-        label = self.GetLabel()
-        font = self.GetFont()
-        if not font:
-            font = wx.SystemSettings.GetFont(wx.SYS_DEFAULT_GUI_FONT)
+    def Wrap(self, width, label=None):
+        """
+        Wraps the text to width from now on, and displays label if it is not
+        ``None``. Line breaks are kept apart from the label, so the runs are
+        never modified. The lines are laid out on the layout thread, and only
+        for the latest width if this is called again before it is done.
+        """
         dc = wx.ClientDC(self)
-        dc.SetFont(font)
-        newlabel = wx.lib.wordwrap.wordwrap(label, width, dc)
-        if label != newlabel:
-            currindex = 0
-            offset = 0
-            for c in newlabel:
-                if currindex >= len(self.label):
-                    break
-                curr = self.label[currindex]
-                if c != curr.text[offset]:
-                    curr.text = curr.text[:offset] + c + curr.text[offset:]
-                offset += 1
-                if offset >= len(curr.text):
-                    currindex += 1
-                    offset = 0
-        self.SetLabel(self.label)
+        dc.SetFont(self.GetFont())
+        # Leave the same slack as wx.lib.wordwrap.
+        width -= dc.GetTextExtent(' ')[0] + dc.GetTextExtent('W')[0]
+        if width != self._wrapwidth:
+            self._wrapwidth = width
+            self._requestlayout(0, measure=False)
+        if label is not None:
+            self.SetLabel(label)
 
 class MyFrame(wx.Frame):
+    _colors = {TextEntry.PENDING: "white", TextEntry.SENT: "light gray", TextEntry.SUCCESS: "green", TextEntry.FAILED: "red"}
+
     def __init__(self, parent=None):
         super().__init__(parent, title="Plover Captions for YouTube Live")
 
         self.client = Client()
+        datadir = wx.StandardPaths.Get().GetUserDataDir()
+        os.makedirs(datadir, exist_ok=True)
 
         vbox = wx.BoxSizer(wx.VERTICAL)
         self.SetSizer(vbox)
@@ -396,14 +679,27 @@ class MyFrame(wx.Frame):
         url = wx.TextCtrl(self)
         hbox.Add(url, border=3, flag=wx.ALL)
         url.Bind(wx.EVT_TEXT, self.OnURLChange)
+        self._url = url
+
+        hbox.Add(wx.StaticText(self, label="Backups: "), flag=wx.ALL, border=3)
+        backups = wx.TextCtrl(self)
+        backups.SetToolTip("Further URLs to send the same captions to, separated by spaces")
+        hbox.Add(backups, border=3, flag=wx.ALL)
+        backups.Bind(wx.EVT_TEXT, self.OnURLChange)
+        self._backups = backups
         url.SetValue(self.client.url)
+
+        stats = wx.CheckBox(self, label="Stats")
+        hbox.Add(stats, border=3, flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
+        stats.Bind(wx.EVT_CHECKBOX, self.OnStatsToggle)
         
-        self._delay = datetime.timedelta(seconds=5)
+        self._policy = AdaptivePolicy()
+        self._poll_interval = 1000 # milliseconds
         hbox.Add(wx.StaticText(self, label="Delay: "), flag = wx.ALL, border=3)
         delay = wx.TextCtrl(self)
         hbox.Add(delay, border=3, flag=wx.ALL)
         delay.Bind(wx.EVT_TEXT, self.OnDelayChange)
-        delay.SetValue(str(self._delay.total_seconds()))
+        delay.SetValue(str(self._policy.delay))
 
         hbox.Add(wx.StaticText(self, label="Offset: "), flag = wx.ALL, border=3)
         offset = wx.TextCtrl(self)
@@ -416,25 +712,59 @@ class MyFrame(wx.Frame):
         vbox.Add(self.scroll, proportion=3, flag = wx.EXPAND | wx.ALL, border=3)
         scrollvbox = wx.BoxSizer(wx.VERTICAL)
         self.output = ColoredStaticText(self.scroll)
+        self.output.layout_callback = self._scroll_to_end
 
         scrollvbox.Add(self.output, flag=wx.EXPAND)
         self.scroll.SetSizer(scrollvbox)
         self.scroll.SetAutoLayout(True)
         self.scroll.SetupScrolling(scroll_x=False)
 
-        self._pending = collections.deque()
+        metrics = self.client.metrics
+        self._display_histogram = metrics.histogram('caption_display_seconds', "Time to rebuild the caption display")
+        self.output.paint_histogram = metrics.histogram('caption_paint_seconds', "Time to paint the caption display")
+        self.output.layout_histogram = metrics.histogram('caption_layout_seconds', "Time to wrap the caption display")
+        metrics.gauge('caption_entries', "Entries held by state", lambda: len(self._pending), state='unreleased')
+        self.stats = wx.StaticText(self)
+        self.stats.SetFont(wx.Font(wx.FontInfo().Family(wx.FONTFAMILY_TELETYPE)))
+        self.stats.Hide()
+        vbox.Add(self.stats, flag=wx.EXPAND | wx.ALL, border=3)
+        self._stats_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, lambda e: self._show_stats(), self._stats_timer)
+
+        self._pending = PendingText()
+        self._selection = (0, 0)
+        self._releasing = False
         self.input = wx.TextCtrl(self, style=wx.TE_MULTILINE)
         self.input.Bind(wx.EVT_TEXT, self.OnText)
+        self.input.Bind(wx.EVT_KEY_UP, self.OnSelection)
+        self.input.Bind(wx.EVT_LEFT_UP, self.OnSelection)
         vbox.Add(self.input, proportion=1, flag=wx.EXPAND | wx.ALL, border=3)
 
         self.statusbar = self.CreateStatusBar()
-        self.statusbar.SetStatusText("Disconnected")
-        self.client.post_callback = lambda success: wx.CallAfter(self.OnStatus, success)
+        self.OnStatus()
+        self.client.post_callback = lambda destination, success: wx.CallAfter(self.OnStatus)
+        # Changes to the client's spans not yet shown, and the part of the
+        # spans that is.
+        self._changes = collections.deque()
+        self._shown_start = 0
+        self._shown_end = 0
+        self.client.change_callback = self._on_change
+        self._display_queued = False
+        self._release_timer = None
         self.Fit()
+        self.output.Wrap(self.scroll.GetSize().width)
         self.Bind(wx.EVT_ACTIVATE, self.OnActivate)
-        self.Bind(wx.EVT_SIZE, lambda x: (x.Skip(), self._display()))
+        self.scroll.Bind(wx.EVT_SIZE, self.OnResize)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
         self.Show(True)
-        self.Tick()
+        # Each copy of the app running at once needs a journal of its own.
+        for n in itertools.count(1):
+            self.client.journal_path = os.path.join(datadir, "journal.jsonl" if n == 1 else "journal.{n}.jsonl".format(n=n))
+            try:
+                self.client.start()
+                break
+            except JournalLocked:
+                pass
 
     def OnActivate(self, e):
         # This event gets sent after the input is deleted on app close
@@ -444,86 +774,173 @@ class MyFrame(wx.Frame):
         except:
             pass
         
+    def _on_change(self, changes):
+        """Queues changes to the client's spans for the display. Called on the client's thread."""
+        self._changes.extend(changes)
+        if not self._display_queued:
+            self._display_queued = True
+            wx.CallAfter(self._display)
+
     def _display(self):
-        colormap = {TextEntry.PENDING: "white", TextEntry.SENT: "light gray", TextEntry.SUCCESS: "green", TextEntry.FAILED: "red"}
-        label = [ColoredText(item.text, "black", colormap[item.status]) for item in self.client.entries()]
-        collapsed = []
-        for item in label:
-            if not collapsed:
-                collapsed.append(item)
-            elif collapsed[-1].color != item.color or collapsed[-1].bgcolor != item.bgcolor:
-                collapsed.append(item)
-            else:
-                collapsed[-1].text += item.text
-        label = collapsed
-        self.output.SetLabel(label)
-        self.output.Wrap(self.scroll.GetSize().width)
+        """
+        Brings the captions up to date with the changes queued since last
+        time, appending new text and recoloring only the ranges that changed.
+        """
+        self._display_queued = False
+        started = time.perf_counter()
+        output = self.output
+        while self._changes:
+            start, end, status = self._changes.popleft()
+            if status is None:
+                output.RemoveLabel(end - self._shown_start)
+                self._shown_start = end
+                continue
+            color = self._colors[status]
+            if end > self._shown_end:
+                with self.client.lock:
+                    text = self.client.text(max(start, self._shown_end), end)
+                output.AppendLabel([ColoredText(text, "black", color)])
+            if start < self._shown_end:
+                output.RestyleLabel(start - self._shown_start, min(end, self._shown_end) - self._shown_start, "black", color)
+            self._shown_end = max(self._shown_end, end)
+        self._display_histogram.observe(time.perf_counter() - started)
+
+    def _scroll_to_end(self):
         self.scroll.FitInside()
         self.scroll.Scroll(-1, self.scroll.GetClientSize().height)
+
+    def OnResize(self, e):
+        # The layout thread only wraps to the last of a burst of sizes.
+        e.Skip()
+        self.output.Wrap(e.GetSize().width)
+
+    def OnStatsToggle(self, e):
+        if e.IsChecked():
+            self._show_stats()
+            self.stats.Show()
+            self._stats_timer.Start(1000)
+        else:
+            self._stats_timer.Stop()
+            self.stats.Hide()
+        self.Layout()
+
+    def _show_stats(self):
+        """Shows a summary of the client's metrics."""
+        values = self.client.metrics.snapshot()
+        def ms(seconds):
+            return '-' if seconds is None else '{:.0f}'.format(seconds * 1000)
+        def quantiles(name):
+            value = values.get(name) or {}
+            return "{name} {p50}/{p95} ms".format(name=name.replace('caption_', '').replace('_seconds', ''), p50=ms(value.get('p50')), p95=ms(value.get('p95')))
+        lines = [
+            "p50/p95  " + "  ".join(quantiles(name) for name in ('caption_release_seconds', 'caption_post_seconds', 'caption_ack_seconds')),
+            "entries  " + "  ".join("{state} {n}".format(state=state, n=values.get('caption_entries{{state="{state}"}}'.format(state=state))) for state in ('unreleased', 'pending', 'sent', 'confirmed')),
+            "drawing  " + "  ".join(quantiles(name) for name in ('caption_display_seconds', 'caption_layout_seconds', 'caption_paint_seconds')),
+        ]
+        for destination in self.client.destinations:
+            label = '{{destination="{name}"}}'.format(name=destination.name)
+            rtt = values.get('caption_post_rtt_seconds' + label) or {}
+            lines.append("{name:8} rtt {p50}/{p95} ms  ok {ok}  failed {failed}  retries {retries}  gave up {gaveup}  dropped {dropped}  clock {correction} \u00b1{error} ms".format(
+                name=destination.name,
+                p50=ms(rtt.get('p50')),
+                p95=ms(rtt.get('p95')),
+                ok=values.get('caption_posts_total{{destination="{name}",result="success"}}'.format(name=destination.name)),
+                failed=values.get('caption_posts_total{{destination="{name}",result="failure"}}'.format(name=destination.name)),
+                retries=values.get('caption_retries_total' + label),
+                gaveup=values.get('caption_failed_batches_total' + label),
+                dropped=values.get('caption_dropped_entries_total' + label),
+                correction=ms(values.get('caption_clock_correction_seconds' + label)),
+                error=ms(values.get('caption_clock_error_seconds' + label))))
+        self.stats.SetLabel("\n".join(lines))
+        self.Layout()
         
+    def OnSelection(self, e):
+        e.Skip()
+        self._selection = self.input.GetSelection()
+
     def OnText(self, e):
-        text = self.input.GetValue()
-        pending = self._pending
-        self._pending = collections.deque()
-        for item in pending:
-            piece = text[:len(item.text)]
-            text = text[len(item.text):]
-            if item.text == piece:
-                self._pending.append(item)
-            else:
-                common = os.path.commonprefix([item.text, piece])
-                if common:
-                    prefix = TextEntry()
-                    prefix.time = item.time
-                    prefix.text = common
-                    self._pending.append(prefix)
-                text = piece[len(common):] + text
-                if text:
-                    suffix = TextEntry()
-                    suffix.text = text
-                    self._pending.append(suffix)
-                    text = ''
-                break
-        if text:
-            self._pending.append(TextEntry(text))
-
-    def Tick(self):
-        now = datetime.datetime.utcnow()
-        allowedlength = len(self.input.GetRange(0, self.input.GetInsertionPoint()))
-        tosend = []
-        while self._pending and now - self._pending[0].time >= self._delay and len(self._pending[0].text) <= allowedlength:
-            item = self._pending.popleft()
-            tosend.append(item)
-            allowedlength -= len(item.text)
+        if self._releasing:
+            return
+        now = time.monotonic_ns()
+        self._policy.keystroke(now)
+        # Work out the edit from the selection before it and the caret
+        # after it, assuming the caret ends up after any inserted text.
+        # This holds for typing, pasting, backspace and delete.
+        length = self.input.GetLastPosition()
+        pos = self.input.GetInsertionPoint()
+        selstart, selend = self._selection
+        start = min(selstart, pos)
+        removed = (pos - start) - (length - self._pending.length())
+        inserted = self.input.GetRange(start, pos) if pos > start else ''
+        # Positions only match offsets when newlines are one character.
+        simple = wx.Platform != '__WXMSW__' or not self._pending.newlines and '\n' not in inserted
+        if simple and 0 <= removed and start + removed <= self._pending.length():
+            self._pending.edit(start, removed, inserted, now, self._policy)
+            # Check the edit against a little of the text around it.
+            lo, hi = max(start - 8, 0), min(pos + 8, length)
+            if self._pending.length() != length or self._pending.text(lo, hi) != self.input.GetRange(lo, hi):
+                self._pending.sync(self.input.GetValue(), now, self._policy)
+        else:
+            self._pending.sync(self.input.GetValue(), now, self._policy)
+        self._selection = (pos, pos)
+        self._schedule_release(now, False)
+
+    def _schedule_release(self, now, released):
+        """
+        Sets the release timer for the policy's next deadline. If the
+        deadline has passed but the text was held back, for instance by the
+        caret, released is True and the check is repeated after a while.
+        """
+        deadline = self._policy.deadline(self._pending, now, self.client.rtt)
+        if deadline is None:
+            if self._release_timer:
+                self._release_timer.Stop()
+            return
+        delay = (deadline - now) // 1000000
+        if delay <= 0:
+            delay = self._poll_interval if released else 0
+        # It seems like this can be garbage collected, contrary to the docs.
+        # So we need to hold a reference to it until it runs.
+        if self._release_timer:
+            self._release_timer.Start(delay)
+        else:
+            self._release_timer = wx.CallLater(delay, self.Release)
+
+    def Release(self):
+        """Sends the text the release policy considers settled."""
+        now = time.monotonic_ns()
+        allowedlength = self.input.GetInsertionPoint()
+        if self._pending.newlines and wx.Platform == '__WXMSW__':
+            allowedlength = len(self.input.GetRange(0, allowedlength))
+        count = 0
+        limit = self._policy.release(self._pending, now, self.client.rtt)
+        while count < limit and len(self._pending[count].text) <= allowedlength:
+            allowedlength -= len(self._pending[count].text)
+            count += 1
+        tosend = self._pending.release(count)
         if tosend:
+            self._policy.released(now)
             self.client.send(tosend)
-            pos = self.input.GetInsertionPoint()
-            value = self.input.GetValue()
-            endpos = self.input.GetLastPosition()
-            toremove = ''.join(item.text for item in tosend)
-            offset = len(toremove)
-            newvalue = value[offset:]
-            pos -= offset
-            if len(value) != endpos: # This means newlines are two chars.
-                pos -= toremove.count('\n')
-            self.input.ChangeValue(newvalue)
-            self.input.SetInsertionPoint(pos)
-        
-        delay = int(self.client.tick() * 1000)
-        self._display()
-        if delay > 0:
-            # It seems like this can be garbage collected, contrary to the docs.
-            # So we need to hold a reference to it until it runs.
-            self._tick = wx.CallLater(delay, self.Tick)
-        else:
-            wx.CallAfter(self.Tick)
+            # Remove the released text from the front of the input without
+            # touching the rest of it.
+            toremove = sum(len(item.text) for item in tosend)
+            if wx.Platform == '__WXMSW__': # newlines are two positions
+                toremove += sum(item.text.count('\n') for item in tosend)
+            self._releasing = True
+            try:
+                self.input.Remove(0, toremove)
+            finally:
+                self._releasing = False
+            self._selection = self.input.GetSelection()
+        self._schedule_release(now, True)
 
     def OnURLChange(self, e):
-        self.client.url = e.String.strip()
+        self.client.urls = [self._url.GetValue().strip()] + self._backups.GetValue().split()
+        wx.CallAfter(self.OnStatus)
         
     def OnDelayChange(self, e):
         try:
-            self._delay = datetime.timedelta(seconds=int(e.String.strip()))
+            self._policy.delay = int(e.String.strip())
         except ValueError:
             pass
         
@@ -533,11 +950,30 @@ class MyFrame(wx.Frame):
         except ValueError:
             pass
         
-    def OnStatus(self, success):
-        if success:
-            self.statusbar.SetStatusText("Connected")
-        else:
-            self.statusbar.SetStatusText("Disconnected")
+    def OnStatus(self):
+        """Shows the health of each destination in a field of its own."""
+        destinations = list(self.client.destinations)
+        if self.statusbar.GetFieldsCount() != len(destinations):
+            self.statusbar.SetFieldsCount(len(destinations))
+        now = time.monotonic_ns()
+        for index, destination in enumerate(destinations):
+            name = "Primary" if index == 0 else "Backup {n}".format(n=index)
+            if destination.connected:
+                error = destination.clock.error(now)
+                if error is None:
+                    status = "Connected"
+                else:
+                    status = "Connected, clock \u00b1{ms:.0f} ms".format(ms=error * 1000)
+            else:
+                status = "Disconnected"
+            self.statusbar.SetStatusText("{name}: {status}".format(name=name, status=status), index)
+
+    def OnClose(self, e):
+        self._stats_timer.Stop()
+        if self._release_timer:
+            self._release_timer.Stop()
+        self.client.stop()
+        e.Skip()
 
 def gui():
     app = wx.App(False)
@@ -545,9 +981,10 @@ def gui():
     app.MainLoop()
 
 def client_test():
+    """Types the text below, with mistakes taken back, into a Client posting to a local server.py."""
     c = Client()
     c.url = 'http://localhost:8080/?foo'
-    def callback(success):
+    def callback(destination, success):
         if success:
             print("success")
         else:
@@ -563,17 +1000,18 @@ def client_test():
     Mucius bonorum vis ad, usu ei oporteat repudiare. Eum ex nonumy doctus, quo omnis deleniti eu, ea qui recusabo quaerendum necessitatibus. Id qui wisi philosophia, assum eripuit vis at, usu cu adipisci invenire voluptatibus. Ex probo noster equidem eum, cu ferri possim per, id natum liberavisse vis. An nam graeco timeam deserunt.
 
     Ea probo assum inimicus sea, omnes admodum ius at. No eripuit labores propriae sed, consul civibus ea mei, nemore officiis ad sea. Sed minim equidem vituperatoribus no. Omnium virtute elaboraret vel ei."""
-    words = iter(s.split())
+    c.start()
+    streamer = Streamer(c, c._scheduler)
     try:
-        while True:
-            while random.choice([True, False]):
-                c.text(next(words) + " ")
-            while random.choice([True, False]):
-                c.delete(1)
-            time.sleep(c.tick())
-    except StopIteration:
-        pass
-        
+        for word in s.split():
+            streamer.edit(0, word + " ")
+            while random.random() < 0.1:
+                streamer.edit(1, "")
+            time.sleep(random.uniform(0.1, 0.5))
+        streamer.flush().wait()
+        time.sleep(1)
+    finally:
+        c.stop()
 
 if __name__ == "__main__":
     gui()
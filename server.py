@@ -1,18 +1,219 @@
-import http.server
+import argparse
+import collections
 import datetime
+import http.server
+import json
+import math
 import random
+import re
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+
+class Stream:
+    """What the simulator knows about one caption stream, identified by its URL without seq."""
+    def __init__(self):
+        self.seqs = set() # accepted sequence numbers
+        self.highest = 0
+        self.tokens = None # for rate limiting
+        self.refilled = time.monotonic()
 
 class handler(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in for the YouTube caption ingestion endpoint. It checks the
+    body format and seq numbers, records what it accepts, and can be made
+    slow, unreliable, rate limited or skewed in time.
+    """
+    protocol_version = 'HTTP/1.1' # keep connections alive
+    disable_nagle_algorithm = True
+
+    # settings, from the command line
+    fail_rate = 0.5
+    reset_rate = 0
+    latency = 0
+    jitter = 0
+    latency_dist = 'fixed'
+    skew = 0
+    drift = 0
+    rate_limit = None
+    verbose = False
+    record = None
+
+    # state shared by all connections
+    lock = threading.Lock()
+    streams = collections.defaultdict(Stream)
+    stats = collections.Counter()
+    started = time.monotonic()
+
+    _timestamp = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}( region:\S+)?$')
+
+    @classmethod
+    def delay(cls):
+        """Returns a response delay drawn from the configured distribution."""
+        if cls.latency_dist == 'uniform':
+            return max(random.uniform(cls.latency - cls.jitter, cls.latency + cls.jitter), 0)
+        if cls.latency_dist == 'exponential':
+            return random.expovariate(1 / cls.latency) if cls.latency else 0
+        if cls.latency_dist == 'lognormal':
+            if not cls.latency:
+                return 0
+            # Parameters giving the configured mean and standard deviation.
+            sigma2 = math.log(1 + (cls.jitter / cls.latency) ** 2)
+            return random.lognormvariate(math.log(cls.latency) - sigma2 / 2, math.sqrt(sigma2))
+        return cls.latency
+
+    @classmethod
+    def parse(cls, body):
+        """Returns the (time, text) pairs in body, or raises ValueError."""
+        if not body.endswith('\n'):
+            raise ValueError("body doesn't end with a newline")
+        lines = body[:-1].split('\n')
+        if len(lines) % 2:
+            raise ValueError("odd number of lines")
+        entries = []
+        for i in range(0, len(lines), 2):
+            if not cls._timestamp.match(lines[i]):
+                raise ValueError("bad timestamp on line {n}: {line!r}".format(n=i + 1, line=lines[i][:40]))
+            entries.append((lines[i], lines[i + 1]))
+        return entries
+
+    def reply(self, status, text=''):
+        now = datetime.datetime.utcnow()
+        if self.skew or self.drift:
+            now += datetime.timedelta(seconds=self.skew + self.drift * 1e-6 * (time.monotonic() - self.started))
+        body = (now.isoformat(timespec='milliseconds') + '\r\n' + text).encode('UTF-8')
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reset(self):
+        """Drops the connection with a TCP reset instead of answering."""
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = True
+
     def do_POST(self):
-        print(self.headers, end='')
-        print(self.rfile.read(int(self.headers.get('Content-Length'))).decode('UTF-8'))
-        date = (datetime.datetime.utcnow().isoformat()[:-3] + '\r\n').encode('UTF-8')
-        self.send_response(random.choice([200, 500]))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('UTF-8', 'replace')
+        if self.verbose:
+            print(self.headers, end='')
+            print(body)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+        seqs = [value for key, value in query if key == 'seq']
+        key = url.path + '?' + urllib.parse.urlencode([(k, v) for k, v in query if k != 'seq'])
+        received = datetime.datetime.utcnow().isoformat(timespec='milliseconds')
+
+        time.sleep(self.delay())
+        if random.random() < self.reset_rate:
+            self.count('resets')
+            self.reset()
+            return
+        try:
+            if len(seqs) != 1 or not seqs[0].isdigit():
+                raise ValueError("missing or bad seq")
+            seq = int(seqs[0])
+            entries = self.parse(body)
+        except ValueError as e:
+            self.count('rejected')
+            self.reply(400, str(e))
+            return
+        with self.lock:
+            stream = self.streams[key]
+            if self.rate_limit:
+                now = time.monotonic()
+                if stream.tokens is None:
+                    stream.tokens = self.rate_limit
+                stream.tokens = min(self.rate_limit, stream.tokens + (now - stream.refilled) * self.rate_limit)
+                stream.refilled = now
+                if stream.tokens < 1:
+                    self.stats['rate_limited'] += 1
+                    limited = True
+                else:
+                    stream.tokens -= 1
+                    limited = False
+            else:
+                limited = False
+        if limited:
+            self.reply(429)
+            return
+        if random.random() < self.fail_rate:
+            self.count('failed')
+            self.reply(500)
+            return
+        with self.lock:
+            self.stats['accepted'] += 1
+            if seq in stream.seqs:
+                self.stats['duplicates'] += 1
+            else:
+                late = seq < stream.highest
+                if late:
+                    self.stats['late'] += 1
+                stream.seqs.add(seq)
+                stream.highest = max(stream.highest, seq)
+                self.stats['entries'] += len(entries)
+                if self.record:
+                    record = {'stream': key, 'seq': seq, 'received': received, 'late': late, 'entries': entries}
+                    self.record.write(json.dumps(record) + '\n')
+        self.reply(200)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        with self.lock:
+            stats = dict(self.stats, streams=len(self.streams))
+        body = json.dumps(stats).encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(date)
-        return
+        self.wfile.write(body)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # hundreds of clients may connect at once
 
 if __name__ == '__main__':
-    address = ('', 8080)
-    server = http.server.HTTPServer(address, handler)
-    server.serve_forever()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Local stand-in for the YouTube caption ingestion endpoint.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fail-rate', type=float, default=handler.fail_rate, help="fraction of posts answered with 500")
+    parser.add_argument('--reset-rate', type=float, default=handler.reset_rate, help="fraction of posts answered by resetting the connection")
+    parser.add_argument('--latency', type=float, default=handler.latency, help="mean seconds to wait before answering")
+    parser.add_argument('--jitter', type=float, default=handler.jitter, help="spread of the latency in seconds: half the range for uniform, the standard deviation for lognormal")
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'exponential', 'lognormal'], default=handler.latency_dist)
+    parser.add_argument('--skew', type=float, default=handler.skew, help="seconds the reply clock is ahead")
+    parser.add_argument('--drift', type=float, default=handler.drift, help="parts per million the reply clock gains")
+    parser.add_argument('--rate-limit', type=float, help="posts per second allowed per stream; more are answered with 429")
+    parser.add_argument('--record', metavar='PATH', help="file to write accepted posts to, as JSON lines")
+    parser.add_argument('--verbose', action='store_true', help="print every request")
+    args = parser.parse_args()
+    handler.fail_rate = args.fail_rate
+    handler.reset_rate = args.reset_rate
+    handler.latency = args.latency
+    handler.jitter = args.jitter
+    handler.latency_dist = args.latency_dist
+    handler.skew = args.skew
+    handler.drift = args.drift
+    handler.rate_limit = args.rate_limit
+    handler.verbose = args.verbose
+    if args.record:
+        handler.record = open(args.record, 'w', buffering=1)
+    address = ('', args.port)
+    server = Server(address, handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(dict(handler.stats, streams=len(handler.streams))))
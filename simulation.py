@@ -0,0 +1,309 @@
+"""
+Replays stenographer input through the release policy and Client in
+simulated time, against a scripted network, and reports caption latency,
+loss and traffic. Hours of captioning run in seconds, and a given seed
+always gives the same result.
+
+    python simulation.py --hours 4 --phase 0:latency=0.05,fail=0.05 --phase 3600:fail=1 --phase 3660:fail=0.05
+    python simulation.py --plover-log plover.log
+"""
+import argparse
+import datetime
+import heapq
+import json
+import math
+import random
+import re
+import time
+
+from captions import AdaptivePolicy, Client, PloverFormatter, Scheduler, Streamer, TextEntry, TransportError, wallclock
+
+class SimulatedScheduler(Scheduler):
+    """
+    A Scheduler that is also its own clock, and only moves time forward
+    when run() reaches the next timer. Nothing runs on other threads.
+    """
+    def __init__(self, start=None):
+        super().__init__(clock=self)
+        self.now = time.monotonic_ns() if start is None else start
+        # Time spent inside the post being run by SimulatedExecutor.
+        self.elapsed = 0
+
+    def monotonic_ns(self):
+        return self.now + self.elapsed
+
+    def monotonic(self):
+        return self.monotonic_ns() / 1e9
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def run(self, until=None):
+        """Runs timers in order until there are none left or the next is after until."""
+        while self._heap:
+            when, _, timer = self._heap[0]
+            if until is not None and when > until:
+                break
+            heapq.heappop(self._heap)
+            # Rounded up, so no timer sees a clock short of its time.
+            self.now = max(self.now, math.ceil(when * 1e9))
+            if not timer.cancelled:
+                timer.fn(*timer.args)
+        if until is not None:
+            self.now = max(self.now, math.ceil(until * 1e9))
+
+class SimulatedFuture:
+    def __init__(self, scheduler, done, result=None, exception=None):
+        self._scheduler = scheduler
+        self._done = done
+        self._result = result
+        self._exception = exception
+
+    def result(self):
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        self._scheduler.call_at(self._done / 1e9, fn, self)
+
+class SimulatedExecutor:
+    """
+    Runs each post at once, letting the simulated transport add its latency
+    to the clock the post sees, and reports the result that much later.
+    """
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+
+    def submit(self, fn, *args):
+        scheduler = self._scheduler
+        scheduler.elapsed = 0
+        try:
+            result, exception = fn(*args), None
+        except Exception as e:
+            result, exception = None, e
+        done = scheduler.monotonic_ns()
+        scheduler.elapsed = 0
+        return SimulatedFuture(scheduler, done, result, exception)
+
+    def shutdown(self, wait=True):
+        pass
+
+class Network:
+    """
+    The ingestion server and the network to it, following a script of
+    phases. Each phase sets the mean latency and its spread, the fraction
+    of posts that fail and how far the server clock is off, from its start
+    time until the next phase.
+    """
+    def __init__(self, scheduler, phases, rng):
+        self._scheduler = scheduler
+        self._start = scheduler.monotonic_ns()
+        self._phases = sorted(phases)
+        self._rng = rng
+        self.posts = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.bytes = 0
+
+    def _conditions(self):
+        seconds = (self._scheduler.monotonic_ns() - self._start) / 1e9
+        conditions = {'latency': 0.05, 'jitter': 0.02, 'fail': 0.0, 'skew': 0.0}
+        for start, settings in self._phases:
+            if start > seconds:
+                break
+            conditions.update(settings)
+        return conditions
+
+    def transport(self):
+        return _Transport(self)
+
+    def post(self, body, timeout):
+        scheduler = self._scheduler
+        conditions = self._conditions()
+        self.posts += 1
+        self.bytes += len(body)
+        latency = max(self._rng.gauss(conditions['latency'], conditions['jitter']), 0.001)
+        if latency > timeout:
+            scheduler.elapsed += int(timeout * 1e9)
+            self.timeouts += 1
+            raise TransportError("timed out")
+        scheduler.elapsed += int(latency * 1e9)
+        if self._rng.random() < conditions['fail']:
+            self.failures += 1
+            raise TransportError("500 Internal Server Error")
+        # The server stamps its reply about halfway through the round trip.
+        server = wallclock(scheduler.monotonic_ns() - int(latency * 5e8)) + datetime.timedelta(seconds=conditions['skew'])
+        return server.isoformat(timespec='milliseconds') + '\r\n'
+
+class _Transport:
+    def __init__(self, network):
+        self._network = network
+        self.pool_size = 1
+
+    def warm(self, url):
+        pass
+
+    def post(self, url, body, headers, timeout):
+        return self._network.post(body, timeout)
+
+def synthetic(hours, rng, wpm=200, correction_rate=0.04):
+    """
+    Yields (seconds, removed, text) edits from a made-up stenographer:
+    words at about wpm with pauses between sentences, and now and then a
+    word taken back and written again.
+    """
+    words = "the a of to and in that is was he for it with as his on be at by i this had not are but from or have an they which one you were her all she there would their we him been has when who will more no if out so said what up its about into than them can only other new some could time these two may then do first any my now such like our over man me even most made after also did many before must through back years where much your way well down should because each just those people how too little state good very make world still own see men work long get here between both life being under never day same another know while last might us great old year off come since against go came right used take three".split()
+    seconds = 0.0
+    count = 0
+    while seconds < hours * 3600:
+        seconds += max(rng.gauss(60 / wpm, 20 / wpm), 0.05)
+        word = rng.choice(words)
+        count += 1
+        if count % rng.randint(8, 20) == 0:
+            word += '.'
+            seconds += rng.expovariate(1 / 1.5)
+            if rng.random() < 0.02:
+                seconds += rng.uniform(5, 30) # a break in the speech
+        yield seconds, 0, ' ' + word
+        if rng.random() < correction_rate:
+            seconds += rng.uniform(0.2, 1.5)
+            yield seconds, len(word) + 1, ''
+            seconds += 60 / wpm
+            yield seconds, 0, ' ' + rng.choice(words)
+
+def plover_trace(path):
+    """Yields (seconds, removed, text) edits from the translations in a Plover log."""
+    formatter = PloverFormatter()
+    start = None
+    stamp = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3})')
+    with open(path, encoding='UTF-8', errors='replace') as f:
+        for line in f:
+            match = stamp.match(line)
+            if not match:
+                continue
+            when = datetime.datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S") + datetime.timedelta(milliseconds=int(match.group(2)))
+            if start is None:
+                start = when
+            edit = formatter.feed(line)
+            if edit:
+                yield ((when - start).total_seconds(),) + edit
+
+def json_trace(path):
+    """Yields (seconds, removed, text) edits from a file of JSON lines of those values."""
+    with open(path, encoding='UTF-8') as f:
+        for line in f:
+            if line.strip():
+                yield tuple(json.loads(line))
+
+def simulate(trace, phases=(), seed=0, delay=5, drain=60):
+    """Runs trace against a simulated network and returns a report as a dict."""
+    rng = random.Random(seed)
+    scheduler = SimulatedScheduler()
+    network = Network(scheduler, phases, random.Random(rng.random()))
+    client = Client(scheduler, rng=random.Random(rng.random()), transport=network.transport, executor=lambda workers: SimulatedExecutor(scheduler))
+    client.url = 'http://simulated/?cid=simulation'
+    client.start()
+    streamer = Streamer(client, scheduler, AdaptivePolicy(delay=delay))
+    start = scheduler.monotonic()
+    sent = []
+    client_send = client.send
+    def send(items):
+        items = list(items)
+        sent.extend(items)
+        client_send(items)
+    client.send = send
+
+    wall = time.perf_counter()
+    edits = 0
+    characters = 0
+    end = start
+    for seconds, removed, text in trace:
+        end = start + seconds
+        scheduler.run(end)
+        streamer._edit(removed, text)
+        edits += 1
+        characters += len(text)
+    scheduler.run(end + delay)
+    streamer._flush(_Flag())
+    deadline = end + delay + drain
+    while scheduler.monotonic() < deadline and any(item.status in (TextEntry.PENDING, TextEntry.SENT) for item in sent[-1000:]):
+        scheduler.run(scheduler.monotonic() + 1)
+    client.stop()
+    wall = time.perf_counter() - wall
+
+    snapshot = client.metrics.snapshot()
+    failed = sum(1 for item in sent if item.status == TextEntry.FAILED)
+    unsettled = sum(1 for item in sent if item.status in (TextEntry.PENDING, TextEntry.SENT))
+    simulated = scheduler.monotonic() - start
+    return {
+        'simulated_seconds': simulated,
+        'wall_seconds': wall,
+        'edits': edits,
+        'characters': characters,
+        'entries': len(sent),
+        'failed_entries': failed,
+        'unsettled_entries': unsettled,
+        'loss': failed / len(sent) if sent else 0,
+        'release_seconds': snapshot['caption_release_seconds'],
+        'post_seconds': snapshot['caption_post_seconds'],
+        'ack_seconds': snapshot['caption_ack_seconds'],
+        'posts': network.posts,
+        'failed_posts': network.failures,
+        'timed_out_posts': network.timeouts,
+        'bytes_sent': network.bytes,
+        'bytes_per_minute': network.bytes / simulated * 60 if simulated else 0,
+    }
+
+class _Flag:
+    def set(self):
+        pass
+
+def phase(text):
+    """Parses a phase such as 600:latency=0.2,fail=0.5 from the command line."""
+    start, _, settings = text.partition(':')
+    values = {}
+    for setting in filter(None, settings.split(',')):
+        name, _, value = setting.partition('=')
+        if name not in ('latency', 'jitter', 'fail', 'skew'):
+            raise argparse.ArgumentTypeError("unknown setting {name}".format(name=name))
+        values[name] = float(value)
+    return float(start), values
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs captioning in simulated time and reports latency, loss and traffic.")
+    parser.add_argument('--hours', type=float, default=1, help="length of the synthetic session")
+    parser.add_argument('--wpm', type=float, default=200, help="writing speed of the synthetic session")
+    parser.add_argument('--plover-log', metavar='PATH', help="replay the translations in a Plover log instead")
+    parser.add_argument('--trace', metavar='PATH', help="replay JSON lines of [seconds, removed, text] instead")
+    parser.add_argument('--phase', type=phase, action='append', default=[], metavar='SECONDS:SETTINGS',
+        help="network conditions from SECONDS on, as latency=,jitter=,fail=,skew= (seconds, or a fraction for fail)")
+    parser.add_argument('--delay', type=float, default=5, help="longest time text is held for corrections, in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.plover_log:
+        trace = plover_trace(args.plover_log)
+    elif args.trace:
+        trace = json_trace(args.trace)
+    else:
+        trace = synthetic(args.hours, random.Random(args.seed), args.wpm)
+    report = simulate(trace, args.phase, args.seed, args.delay)
+
+    def ms(value):
+        return '-' if value is None else '{:.0f} ms'.format(value * 1000)
+    print("simulated {sim:.0f} s in {wall:.1f} s ({speed:.0f}x)".format(sim=report['simulated_seconds'], wall=report['wall_seconds'], speed=report['simulated_seconds'] / report['wall_seconds']))
+    print("{edits} edits, {characters} characters, {entries} entries".format(**report))
+    for name in ('release', 'post', 'ack'):
+        value = report[name + '_seconds']
+        print("typing to {name:8} p50 {p50:>8}  p95 {p95:>8}  p99 {p99:>8}".format(name=name, p50=ms(value['p50']), p95=ms(value['p95']), p99=ms(value['p99'])))
+    print("lost {failed_entries} entries ({loss:.2%}), {unsettled_entries} unsettled".format(**report))
+    print("{posts} posts, {failed_posts} failed, {timed_out_posts} timed out, {bytes_sent} bytes ({bytes_per_minute:.0f} per minute)".format(**report))
+
+if __name__ == '__main__':
+    main()